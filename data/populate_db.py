@@ -1,77 +1,195 @@
-from uuid import uuid4
+import argparse
+import io
+import json
+import time
+from typing import Dict, Iterator, List, Optional
 
 import pandas as pd
+import pyarrow.parquet as pq
+from psycopg2.extensions import cursor
 
 from config import settings
 from database.connection import PGConnection
-
-
-def clean_goods_data(file_path) -> pd.DataFrame:
-    df = pd.read_csv(file_path, dtype=str)
-    df["CGST Rate  (%)"] = pd.to_numeric(
-        df["CGST Rate  (%)"].str.replace(r"[^\d.]", "", regex=True), errors="coerce"
-    )
-    df["SGST / UTGST  Rate (%)"] = pd.to_numeric(
-        df["SGST / UTGST  Rate (%)"].str.replace(r"[^\d.]", "", regex=True),
-        errors="coerce",
-    )
-    df["IGST Rate  (%)"] = pd.to_numeric(
-        df["IGST Rate  (%)"].str.replace(r"[^\d.]", "", regex=True), errors="coerce"
+from database.utils import HIDDEN_PREFIXES
+
+NUMERIC_TYPES = {
+    "smallint",
+    "integer",
+    "bigint",
+    "numeric",
+    "real",
+    "double precision",
+}
+
+
+# Reads a CSV or Parquet file in chunks of `chunk_size` rows so memory use stays flat
+def read_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, dtype=str, chunksize=chunk_size)
+
+
+# Loadable columns of the table with their types, in table order
+# The id is generated by the database and the columns added by process_db are skipped
+def get_target_columns(cursor: cursor, table_name: str) -> Dict[str, str]:
+    cursor.execute(
+        """
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s
+        ORDER BY ordinal_position;
+        """,
+        (table_name,),
     )
-    df["Compensation  Cess"] = pd.to_numeric(
-        df["Compensation  Cess"].str.replace(r"[^\d.]", "", regex=True), errors="coerce"
+    return {
+        name: data_type
+        for name, data_type in cursor.fetchall()
+        if name != "id" and not name.startswith(HIDDEN_PREFIXES)
+    }
+
+
+# Maps the source columns onto the table columns, by position unless a mapping is given
+# Text columns that were embedded by process_db are found under their usevec_ name
+def map_columns(
+    source_columns: List[str],
+    target_columns: Dict[str, str],
+    mapping: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    if not mapping:
+        if len(source_columns) != len(target_columns):
+            raise ValueError(
+                f"Source has {len(source_columns)} columns, table has {len(target_columns)}"
+            )
+        return dict(zip(source_columns, target_columns))
+
+    mapped = {}
+    for source, target in mapping.items():
+        if target not in target_columns and f"usevec_{target}" in target_columns:
+            target = f"usevec_{target}"
+        if target not in target_columns:
+            raise ValueError(f"Unknown column {target}")
+        mapped[source] = target
+    return mapped
+
+
+# Takes the number out of values like "2.5%" or "Rs. 1,000": thousands separators are
+# dropped and the first number is kept, so the dot of a currency prefix isn't part of it
+def normalize_numeric(series: pd.Series) -> pd.Series:
+    if pd.api.types.is_numeric_dtype(series):
+        return series
+    numbers = series.str.replace(",", "", regex=False).str.extract(
+        r"(-?(?:\d+(?:\.\d*)?|\.\d+))", expand=False
     )
+    return pd.to_numeric(numbers, errors="coerce")
+
+
+def prepare_chunk(
+    df: pd.DataFrame, columns: Dict[str, str], types: Dict[str, str]
+) -> pd.DataFrame:
+    df = df[list(columns)].rename(columns=columns)
+    for column, data_type in types.items():
+        if data_type in NUMERIC_TYPES:
+            df[column] = normalize_numeric(df[column])
     return df
 
 
-def clean_services_data(file_path) -> pd.DataFrame:
-    df = pd.read_csv(file_path, dtype=str)
-    df["CGST Rate(%)"] = pd.to_numeric(
-        df["CGST Rate(%)"].str.replace(r"[^\d.]", "", regex=True), errors="coerce"
-    )
-    df["SGST/UTGST Rate(%)"] = pd.to_numeric(
-        df["SGST/UTGST Rate(%)"].str.replace(r"[^\d.]", "", regex=True), errors="coerce"
-    )
-    df["IGST Rate(%)"] = pd.to_numeric(
-        df["IGST Rate(%)"].str.replace(r"[^\d.]", "", regex=True), errors="coerce"
+# Streams one chunk into the table with COPY, empty values are loaded as NULL
+def copy_chunk(cursor: cursor, table_name: str, df: pd.DataFrame) -> None:
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    cursor.copy_expert(
+        f"COPY {table_name} ({', '.join(df.columns)}) "
+        "FROM STDIN WITH (FORMAT csv, NULL '')",
+        buffer,
     )
-    return df
 
 
-def insert_data(path: str) -> None:
+# Bulk loads a CSV or Parquet file into the table named after the file
+# `mapping` ({source column: table column}) and `types` ({table column: type}) override
+# the positional mapping and the types read from the table
+# The whole file is loaded in one transaction, returns the number of loaded rows
+def insert_data(
+    path: str,
+    table_name: Optional[str] = None,
+    mapping: Optional[Dict[str, str]] = None,
+    types: Optional[Dict[str, str]] = None,
+    chunk_size: int = 100_000,
+    truncate: bool = False,
+) -> int:
+    table_name = table_name or path.split("/")[-1].split(".")[0]
+
     c = PGConnection(settings.POSTGRES_DSN.unicode_string())
     conn = c.get_conn()
     cursor = conn.cursor()
 
-    table_name = path.split("/")[-1].split(".")[0]
-    if table_name == "goods":
-        df = clean_goods_data(path)
-    elif table_name == "services":
-        df = clean_services_data(path)
-
+    rows = 0
+    started = time.perf_counter()
     try:
         conn.autocommit = False
 
-        for index, row in df.iterrows():
-            row_values = tuple(None if pd.isna(value) else value for value in row)
-            row_values = (str(uuid4()),) + row_values
-            placeholders = ", ".join(["%s"] * (len(df.columns) + 1))
+        target_columns = get_target_columns(cursor, table_name)
+        if truncate:
+            cursor.execute(f"TRUNCATE {table_name};")
 
-            sql_query = f"INSERT INTO {table_name} VALUES ({placeholders})"
+        columns = None
+        for df in read_chunks(path, chunk_size):
+            if columns is None:
+                columns = map_columns(list(df.columns), target_columns, mapping)
+                column_types = {
+                    column: (types or {}).get(column, target_columns[column])
+                    for column in columns.values()
+                }
 
-            cursor.execute(sql_query, row_values)
+            copy_chunk(cursor, table_name, prepare_chunk(df, columns, column_types))
+
+            rows += len(df)
+            elapsed = time.perf_counter() - started
+            print(f"{table_name}: {rows} rows ({rows / elapsed:.0f} rows/s)")
 
         conn.commit()
-        conn.autocommit = True
     except Exception as e:
+        conn.rollback()
         print(e)
+        rows = 0
     finally:
         conn.close()
 
+    return rows
+
 
 # Populate the database with excel data for demo
+# A JSON config can describe other files:
+# {"files": [{"path": "...", "table": "...", "mapping": {...}, "types": {...}}]}
 if __name__ == "__main__":
-    paths = ["./data/tax_excels/goods.csv", "./data/tax_excels/services.csv"]
-
-    for path in paths:
-        insert_data(path)
+    parser = argparse.ArgumentParser(description="Bulk load CSV/Parquet files")
+    parser.add_argument("paths", nargs="*", help="Files to load, table = file name")
+    parser.add_argument("--config", help="JSON file describing the files to load")
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    parser.add_argument(
+        "--truncate", action="store_true", help="Empty the tables before loading"
+    )
+    args = parser.parse_args()
+
+    files = [{"path": path} for path in args.paths]
+    if args.config:
+        with open(args.config) as f:
+            files.extend(json.load(f)["files"])
+    if not files:
+        files = [
+            {"path": "./data/tax_excels/goods.csv"},
+            {"path": "./data/tax_excels/services.csv"},
+        ]
+
+    for file in files:
+        insert_data(
+            file["path"],
+            table_name=file.get("table"),
+            mapping=file.get("mapping"),
+            types=file.get("types"),
+            chunk_size=args.chunk_size,
+            truncate=args.truncate,
+        )
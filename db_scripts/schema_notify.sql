@@ -0,0 +1,42 @@
+-- Notifies running servers that the schema catalog must be reloaded
+-- The channel is settings.SCHEMA_CATALOG_CHANNEL ('schema_changed' by default), when it is
+-- changed set the same name for the database before running this script:
+--     ALTER DATABASE <db> SET sqlrag.schema_catalog_channel = '<channel>';
+--
+-- CREATE EVENT TRIGGER (the second part) requires a superuser. Without one, skip it: the
+-- description_table trigger still works and process_db sends its own NOTIFY on the channel
+-- after onboarding a table, so only DDL made outside of the pipeline goes unnoticed
+-- (restart the servers or NOTIFY the channel by hand after such changes)
+
+CREATE OR REPLACE FUNCTION schema_catalog_channel() RETURNS text AS $$
+    SELECT COALESCE(
+        NULLIF(current_setting('sqlrag.schema_catalog_channel', true), ''),
+        'schema_changed'
+    );
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION notify_schema_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify(schema_catalog_channel(), TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS description_table_schema_changed ON description_table;
+CREATE TRIGGER description_table_schema_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON description_table
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_schema_changed();
+
+-- Table DDL (new columns, renamed columns, new tables) also changes the rendered samples
+-- Superuser only
+CREATE OR REPLACE FUNCTION notify_schema_ddl() RETURNS event_trigger AS $$
+BEGIN
+    PERFORM pg_notify(schema_catalog_channel(), tg_tag);
+END;
+$$ LANGUAGE plpgsql;
+
+DROP EVENT TRIGGER IF EXISTS schema_ddl_changed;
+CREATE EVENT TRIGGER schema_ddl_changed
+    ON ddl_command_end
+    WHEN TAG IN ('CREATE TABLE', 'ALTER TABLE', 'DROP TABLE')
+    EXECUTE FUNCTION notify_schema_ddl();
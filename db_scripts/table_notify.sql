@@ -0,0 +1,30 @@
+-- Notifies running servers that the data of a table changed, so cached results are dropped
+-- The channel name must match settings.RESULT_CACHE_CHANNEL
+-- Statement level, a bulk load or a process_db batch sends one notification, not one per row
+-- Run again after creating new tables
+
+CREATE OR REPLACE FUNCTION notify_table_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('table_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    t RECORD;
+BEGIN
+    FOR t IN
+        SELECT tablename FROM pg_tables
+        WHERE schemaname = 'public' AND tablename <> 'description_table'
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I;', t.tablename || '_table_changed', t.tablename);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %I '
+            'FOR EACH STATEMENT EXECUTE FUNCTION notify_table_changed();',
+            t.tablename || '_table_changed',
+            t.tablename
+        );
+    END LOOP;
+END;
+$$;
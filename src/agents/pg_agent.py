@@ -1,3 +1,4 @@
+import json
 import uuid
 from typing import Annotated, Any, List
 
@@ -6,17 +7,24 @@ from warnings import filterwarnings
 
 from dotenv import load_dotenv
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
 from langchain_core.runnables import RunnableConfig
-from langchain_core.tools import tool
+from langchain_core.tools import InjectedToolCallId, tool
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import add_messages
 from langgraph.graph.state import CompiledStateGraph
-from langgraph.prebuilt import ToolNode, tools_condition
-from pydantic import BaseModel, Field
-from typing_extensions import TypedDict
+from langgraph.prebuilt import InjectedState, ToolNode, tools_condition
+from langgraph.types import Command
+from typing_extensions import NotRequired, TypedDict
 
 from agents.models import models as union_models
+from agents.plan_cache import plan_cache
+from agents.prompt_budget import (
+    build_results,
+    build_table_samples,
+    count_tokens,
+    emit_prompt_size,
+)
 from agents.prompts import (
     PROMPT_GENERATE_OR_CORRECT_SQL_STATEMENT_HUMAN,
     PROMPT_GENERATE_OR_CORRECT_SQL_STATEMENT_SYS,
@@ -26,11 +34,13 @@ from agents.prompts import (
     sql_queries_output_parser,
     table_names_output_parser,
 )
-from agents.utils import CustomData, convert_rows_to_markdown
+from agents.table_router import plan_tables_match, route_tables
+from agents.utils import (
+    ANSWER_TAG,
+    CustomData,
+    execute_statements,
+)
 from config import settings
-from database.connection import PGConnection
-from database.utils import get_sample
-from retriever.retriever import PGRetriever
 
 filterwarnings("ignore", category=UserWarning)
 
@@ -41,19 +51,40 @@ chat_models = union_models.copy()
 class State(TypedDict):
     messages: Annotated[list, add_messages]
 
-    user_query: str
-    all_tables: list[str]
-    sql_statements: list[str]
-    result_langchain_docs: Any | list[Any]
-    query_error: str
-    core_subject: str
+    # Filled in by the tools as the pipeline runs, a new thread only has messages
+    all_tables: NotRequired[list[str]]
+    sql_statements: NotRequired[list[str]]
+    result_langchain_docs: NotRequired[Any | list[Any]]
+    query_error: NotRequired[str]
+    core_subject: NotRequired[str]
+    # Statements of the similar question GetRequiredTables found in the plan cache, and
+    # whether the current statements are those
+    cached_statements: NotRequired[list[str]]
+    plan_cached: NotRequired[bool]
+
+
+# The question being answered is the latest human message of the thread
+def get_user_query(state: State) -> str:
+    for message in reversed(state["messages"]):
+        if isinstance(message, HumanMessage):
+            return message.content.strip()
+    return ""
+
+
+# Tools write their results to the graph state themselves, the tool-calling LLM only
+# reads a short summary of each step to decide the next one
+def tool_update(tool_call_id: str, summary: str, **update) -> Command:
+    return Command(
+        update={
+            **update,
+            "messages": [ToolMessage(content=summary, tool_call_id=tool_call_id)],
+        }
+    )
 
 
-class ToolSchema(BaseModel):
-    state: State = Field("A State object or dict, following the State schema.")
-    config: RunnableConfig = Field(
-        "A RunnableConfig object, containing the configuration for the tool."
-    )
+# What the tool-calling LLM sees of the generated SQL, it decides on GetCoreSubject with it
+def sql_statements_summary(statements: List[str]) -> str:
+    return f"Generated {len(statements)} SQL statement(s):\n" + "\n".join(statements)
 
 
 async def emit_custom_event(type: str, data: dict, config: RunnableConfig):
@@ -61,15 +92,19 @@ async def emit_custom_event(type: str, data: dict, config: RunnableConfig):
     await task_custom_data.adispatch(config)
 
 
-@tool("GetRequiredTables", args_schema=ToolSchema)
-async def get_tables(state: State, config: RunnableConfig):
+@tool("GetRequiredTables")
+async def get_tables(
+    state: Annotated[State, InjectedState],
+    tool_call_id: Annotated[str, InjectedToolCallId],
+    config: RunnableConfig,
+) -> Command:
     """
     Initializes the text-to-SQL pipeline by retrieving metadata from the `description_table`.
 
     This metadata includes table names and their corresponding descriptions, which are used to help
     the language model identify the most relevant table(s) based on the user's natural language query.
     """
-    user_query: str = state["user_query"]
+    user_query: str = get_user_query(state)
 
     await emit_custom_event(
         type="on_get_tables_start",
@@ -80,71 +115,89 @@ async def get_tables(state: State, config: RunnableConfig):
         config=config,
     )
 
-    c = PGConnection(settings.POSTGRES_DSN.unicode_string())
-    conn = c.get_conn()
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM description_table;")
-        colnames = [desc[0] for desc in cur.description]
-        raw_rows = cur.fetchall()
-        rows = [dict(zip(colnames, row)) for row in raw_rows]
-    conn.close()
-
-    markdown_table = convert_rows_to_markdown(rows)
-
-    prompt = PROMPT_GET_REQUIRED_TABLES.format(
-        user_query=user_query, table_descriptions=markdown_table
-    )
+    # A similar question that was answered before already knows its tables and SQL, the
+    # only plan cache lookup of the question
+    plan = await plan_cache.lookup(user_query) if settings.PLAN_CACHE_ENABLED else None
+    table_names, markdown_table, cached_statements = None, None, []
+    if plan is not None and await plan_tables_match(user_query, plan.tables):
+        table_names, cached_statements = plan.tables, plan.statements
+
+    if table_names is None:
+        # Only the descriptions of the shortlisted tables are shown to the LLM, or none
+        # when one table clearly dominates
+        table_names, markdown_table = await route_tables(user_query)
+
+    if markdown_table is not None:
+        prompt = PROMPT_GET_REQUIRED_TABLES.format(
+            user_query=user_query, table_descriptions=markdown_table
+        )
 
-    messages = [HumanMessage(content=prompt)]
+        messages = [HumanMessage(content=prompt)]
 
-    model_name = config["configurable"].get("model")
+        model_name = config["configurable"].get("model")
 
-    # with open("test/run/get_tables_prompt.md", "w") as f:
-    #     f.write(prompt)
+        # with open("test/run/get_tables_prompt.md", "w") as f:
+        #     f.write(prompt)
 
-    m: BaseChatModel = chat_models[model_name] | table_names_output_parser
+        m: BaseChatModel = chat_models[model_name] | table_names_output_parser
 
-    response = m.invoke(messages, config)
+        response = await m.ainvoke(messages, config)
+        table_names = response["table_names"]
 
     await emit_custom_event(
         type="on_get_tables_end",
         data={
-            "result": ", ".join(response["table_names"]),
+            "result": ", ".join(table_names),
             "tool_call_id": "GetRequiredTables",
         },
         config=config,
     )
 
-    return {"all_tables": response["table_names"]}
+    return tool_update(
+        tool_call_id,
+        f"Selected tables: {', '.join(table_names)}",
+        all_tables=table_names,
+        cached_statements=cached_statements,
+    )
 
 
-@tool("GenerateTableQuery", args_schema=ToolSchema)
-async def generate_table_query(state: State, config: RunnableConfig):
+@tool("GenerateTableQuery")
+async def generate_table_query(
+    state: Annotated[State, InjectedState],
+    tool_call_id: Annotated[str, InjectedToolCallId],
+    config: RunnableConfig,
+) -> Command:
     """
     Second step of the text-to-SQL pipeline.
 
-    Generates executable SQL queries using the user's natural language query and a list of selected table names.
-    This function must be called with **all table names at once**, not individually per table.
+    Generates executable SQL queries using the user's natural language query and the tables selected by `GetRequiredTables`.
+    It takes no arguments: the user query, the selected tables and the last execution error are read from the graph state.
 
     If a previously generated query fails during execution, this function should be **repeatedly invoked**
-    with the original user query and the updated error context (`query_error`)—**no matter how many times an error occurs**.
-    Each new error should be passed back into this function to help the LLM iteratively refine the SQL.
-
-    ⚠️ Always include error context when re-calling due to an execution failure.
+    **no matter how many times an error occurs**. The error is passed to the LLM to iteratively refine the SQL.
     """
-    c = PGConnection(settings.POSTGRES_DSN.unicode_string())
-    conn = c.get_conn()
-    user_query: str = state["user_query"]
+    user_query: str = get_user_query(state)
+
+    all_tables = state.get("all_tables", [])
+
+    # Reuse the SQL of a similar question unless a statement is being corrected
+    cached_statements = state.get("cached_statements", [])
+    if cached_statements and not state.get("query_error"):
+        return tool_update(
+            tool_call_id,
+            sql_statements_summary(cached_statements),
+            sql_statements=cached_statements,
+            query_error="",
+            plan_cached=True,
+        )
 
     system_msg = PROMPT_GENERATE_OR_CORRECT_SQL_STATEMENT_SYS.format()
 
-    all_tables = state.get("all_tables", [])
+    model_name = config["configurable"].get("model")
 
-    all_tables_samples = "\n\n".join(
-        [
-            get_sample(cursor=conn.cursor(), table_name=table_name)
-            for table_name in all_tables
-        ]
+    # Samples of every table, kept within the token budget of the section
+    all_tables_samples, prompt_report = await build_table_samples(
+        all_tables, user_query, model_name
     )
     human_msg = PROMPT_GENERATE_OR_CORRECT_SQL_STATEMENT_HUMAN.format(
         user_query=user_query,
@@ -153,12 +206,8 @@ async def generate_table_query(state: State, config: RunnableConfig):
         query_error=state.get("query_error", ""),
     )
 
-    conn.close()
-
     messages = [SystemMessage(content=system_msg), HumanMessage(content=human_msg)]
 
-    model_name = config["configurable"].get("model")
-
     m: BaseChatModel = chat_models[model_name] | sql_queries_output_parser
 
     # with open("test/run/generate_query.md", "w") as f:
@@ -167,13 +216,30 @@ async def generate_table_query(state: State, config: RunnableConfig):
 
     response = await m.ainvoke(messages, config)
 
-    state["query_error"] = ""
+    await emit_prompt_size(
+        "generate_table_query",
+        system_msg + human_msg,
+        "\n".join(response["queries"]),
+        model_name,
+        prompt_report,
+        config,
+    )
 
-    return {"sql_statements": response["queries"]}
+    return tool_update(
+        tool_call_id,
+        sql_statements_summary(response["queries"]),
+        sql_statements=response["queries"],
+        query_error="",
+        plan_cached=False,
+    )
 
 
-@tool("GetCoreSubject", args_schema=ToolSchema)
-async def get_core_subject(state: State, config: RunnableConfig):
+@tool("GetCoreSubject")
+async def get_core_subject(
+    state: Annotated[State, InjectedState],
+    tool_call_id: Annotated[str, InjectedToolCallId],
+    config: RunnableConfig,
+) -> Command:
     """
     Step 2.5 of the text-to-SQL pipeline (Optional).
 
@@ -188,7 +254,7 @@ async def get_core_subject(state: State, config: RunnableConfig):
 
     🔁 Invoke this function **after** `generate_table_query` and **before** `execute_query`, only when semantic refinement is needed.
     """
-    user_query: str = state["user_query"]
+    user_query: str = get_user_query(state)
 
     await emit_custom_event(
         type="on_get_core_subject_start",
@@ -221,90 +287,91 @@ async def get_core_subject(state: State, config: RunnableConfig):
         config=config,
     )
 
-    return {"core_subject": response.content}
+    return tool_update(
+        tool_call_id,
+        f"Core subject: {response.content}",
+        core_subject=response.content,
+    )
 
 
-@tool("ExecuteQuery", args_schema=ToolSchema)
-async def execute_query(state: State, config: RunnableConfig):
+@tool("ExecuteQuery")
+async def execute_query(
+    state: Annotated[State, InjectedState],
+    tool_call_id: Annotated[str, InjectedToolCallId],
+    config: RunnableConfig,
+) -> Command:
     """
     Step 3 of the text-to-SQL pipeline.
 
-    Executes the generated SQL statements and returns the query results.
-    This function must be called with **all SQL statements at once**—**do not call it individually for each statement**.
+    Executes all the generated SQL statements and stores the query results in the graph state.
+    It takes no arguments: the SQL statements and the core subject are read from the graph state.
 
-    If any statement fails during execution, the pipeline should **re-invoke the `generate_table_query` step**
-    with the corresponding error context (`query_error`). This allows the LLM to analyze the error and regenerate
-    a corrected SQL statement.
+    If any statement fails during execution, the pipeline should **re-invoke the `generate_table_query` step**.
+    This allows the LLM to analyze the error and regenerate a corrected SQL statement.
 
-    🔁 This process should repeat for every failure—if `query_error` is not empty, the pipeline must loop back to `generate_table_query`.
+    🔁 This process should repeat for every failure—if an error is returned, the pipeline must loop back to `generate_table_query`.
     """
-    retriever = PGRetriever()
-    user_query: str = state["user_query"].strip()
-    core_subject: str = state["core_subject"].strip()
+    sql_statements = state.get("sql_statements", [])
+    if not sql_statements:
+        return tool_update(
+            tool_call_id,
+            "Error: no SQL statements to execute.\nCall GenerateTableQuery first.",
+        )
 
-    user_query = core_subject if core_subject else user_query
+    question: str = get_user_query(state)
+    core_subject: str = state.get("core_subject", "").strip()
 
-    results = {
-        "result_langchain_docs": [],
-        "query_error": "",
-    }
+    user_query = core_subject if core_subject else question
 
     try:
-        for statement in state["sql_statements"]:
-            await emit_custom_event(
-                type="on_retriever_start",
-                data={
-                    "sql_query": statement,
-                    "user_query": user_query if "embedding" in statement else None,
-                    "tool_call_id": "PGRetriever",
-                },
-                config=config,
-            )
-
-            docs = retriever.get_relevant_documents(statement, user_query=user_query)
-            results["result_langchain_docs"].append(docs)
-
-            await emit_custom_event(
-                type="on_retriever_end",
-                data={
-                    "result": docs,
-                    "tool_call_id": "PGRetriever",
-                },
-                config=config,
-            )
+        result_langchain_docs = await execute_statements(
+            sql_statements, user_query, config
+        )
     except Exception as e:
-        await emit_custom_event(
-            type="on_retriever_error",
-            data={
-                "error": str(e),
-                "tool_call_id": "PGRetriever",
-            },
-            config=config,
+        # A reused plan that fails is corrected by the LLM and not offered again
+        if state.get("plan_cached"):
+            plan_cache.discard(sql_statements)
+
+        return tool_update(
+            tool_call_id,
+            f"Error: {e}\nCall GenerateTableQuery to correct the SQL statements.",
+            result_langchain_docs="",
+            query_error=f"Error: {e}",
+            plan_cached=False,
         )
 
-        results = {"result_langchain_docs": "", "query_error": f"Error: {e}"}
-        return results
+    # Only new plans are stored, not every paraphrase of a reused one
+    if settings.PLAN_CACHE_ENABLED and not state.get("plan_cached"):
+        await plan_cache.store(question, state.get("all_tables", []), sql_statements)
 
-    return results
+    rows = sum(len(docs) for docs in result_langchain_docs)
+    return tool_update(
+        tool_call_id,
+        f"Executed {len(result_langchain_docs)} SQL statement(s), {rows} row(s) returned",
+        result_langchain_docs=result_langchain_docs,
+        query_error="",
+    )
 
 
-@tool("GenerateResponse", args_schema=ToolSchema)
-async def generate_response(state: State, config: RunnableConfig):
+@tool("GenerateResponse")
+async def generate_response(
+    state: Annotated[State, InjectedState],
+    tool_call_id: Annotated[str, InjectedToolCallId],
+    config: RunnableConfig,
+) -> Command:
     """
     Final step of the text-to-SQL pipeline.
 
     Generates a natural language response using the user's original query and the results returned from the executed SQL statements.
     The LLM combines both inputs to produce a coherent, context-aware, and user-friendly answer.
     """
-    user_query = state["user_query"]
-    result_langchain_docs = state["result_langchain_docs"]
+    user_query = get_user_query(state)
+    result_langchain_docs = state.get("result_langchain_docs") or []
 
-    markdown_table = ""
+    model_name = config["configurable"].get("model")
 
-    for docs in result_langchain_docs:
-        if markdown_table:
-            markdown_table += "\n\n"
-        markdown_table += convert_rows_to_markdown(docs)
+    # Big results are cut to their first rows plus a summary of all of them
+    markdown_table, prompt_report = build_results(result_langchain_docs, model_name)
 
     response_generation_prompt = PROMPT_GENERATE_RESPONSE_FROM_SQL.format(
         user_query=user_query,
@@ -316,12 +383,27 @@ async def generate_response(state: State, config: RunnableConfig):
 
     messages = [HumanMessage(response_generation_prompt)]
 
-    model_name = config["configurable"].get("model")
-
-    m: BaseChatModel = chat_models[model_name]
+    m: BaseChatModel = chat_models[model_name].with_config(tags=[ANSWER_TAG])
     response = await m.ainvoke(messages, config)
 
-    return {"messages": [response]}
+    await emit_prompt_size(
+        "generate_response",
+        response_generation_prompt,
+        response.content,
+        model_name,
+        prompt_report,
+        config,
+    )
+
+    # The answer ends the run, the tool-calling LLM doesn't have to repeat it
+    return Command(
+        update={
+            "messages": [
+                ToolMessage(content="Response generated", tool_call_id=tool_call_id),
+                response,
+            ]
+        }
+    )
 
 
 @tool("Add")
@@ -387,7 +469,34 @@ async def tool_calling_node(state: State, config: RunnableConfig):
     model: BaseChatModel = llm_with_tools[
         config["configurable"].get("model", "azure-gpt-4.1")
     ]
-    return {"messages": [model.invoke(state["messages"])]}
+    response = await model.ainvoke(state["messages"], config)
+
+    # Tool-call arguments are output tokens, the slowest part of the call, so their size
+    # is reported with every hop
+    usage = response.usage_metadata or {}
+    await emit_custom_event(
+        type="on_prompt_size",
+        data={
+            "node": "tool_calling_node",
+            "prompt_tokens": usage.get("input_tokens"),
+            "response_tokens": usage.get("output_tokens"),
+            "tool_calls": [call["name"] for call in response.tool_calls],
+            "tool_call_tokens": count_tokens(
+                json.dumps([call["args"] for call in response.tool_calls]),
+                config["configurable"].get("model", "azure-gpt-4.1"),
+            ),
+        },
+        config=config,
+    )
+
+    return {"messages": [response]}
+
+
+# GenerateResponse ends the run with the answer, otherwise the LLM picks the next step
+def route_tool_results(state: State):
+    if isinstance(state["messages"][-1], AIMessage):
+        return END
+    return "tool_calling_node"
 
 
 graph_builder = StateGraph(State)
@@ -397,7 +506,9 @@ graph_builder.add_node("tools", ToolNode(available_tools))
 
 graph_builder.add_edge(START, "tool_calling_node")
 graph_builder.add_conditional_edges("tool_calling_node", tools_condition)
-graph_builder.add_edge("tools", "tool_calling_node")
+graph_builder.add_conditional_edges(
+    "tools", route_tool_results, {"tool_calling_node": "tool_calling_node", END: END}
+)
 graph_builder.add_edge("tool_calling_node", END)
 
 pg_rag: CompiledStateGraph = graph_builder.compile()
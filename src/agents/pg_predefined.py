@@ -1,3 +1,4 @@
+import asyncio
 from typing import Annotated
 
 from dotenv import load_dotenv
@@ -10,6 +11,8 @@ from langgraph.graph.state import CompiledStateGraph
 from typing_extensions import TypedDict
 
 from agents.models import models
+from agents.plan_cache import plan_cache
+from agents.prompt_budget import build_results, build_table_samples, emit_prompt_size
 from agents.prompts import (
     PROMPT_GENERATE_OR_CORRECT_SQL_STATEMENT_HUMAN,
     PROMPT_GENERATE_OR_CORRECT_SQL_STATEMENT_SYS,
@@ -19,11 +22,14 @@ from agents.prompts import (
     sql_queries_output_parser,
     table_names_output_parser,
 )
-from agents.utils import CustomData, convert_rows_to_markdown
+from agents.table_router import plan_tables_match, route_tables
+from agents.utils import (
+    ANSWER_TAG,
+    CustomData,
+    execute_statements,
+)
 from config import settings
-from database.connection import PGConnection
-from database.utils import get_sample
-from retriever.retriever import PGRetriever
+from retriever.retriever import needs_embedding
 
 load_dotenv()
 
@@ -43,6 +49,51 @@ class State(TypedDict):
     result_langchain_docs: list[dict]
     query_error: str
     core_subject: str
+    plan_cached: bool
+
+
+# Reuses the tables and SQL statements of a similar question that was answered before
+# so the get_tables and generate_table_query LLM calls can be skipped
+async def lookup_plan(state: State, config: RunnableConfig = None):
+    if not settings.PLAN_CACHE_ENABLED:
+        return {"plan_cached": False}
+
+    user_query: str = state["messages"][-1].content.strip()
+    plan = await plan_cache.lookup(user_query)
+    if plan is None or not await plan_tables_match(user_query, plan.tables):
+        return {"plan_cached": False}
+
+    await emit_custom_event(
+        type="on_get_tables_start",
+        data={
+            "query": user_query,
+            "tool_call_id": "GetRequiredTables",
+        },
+        config=config,
+    )
+    await emit_custom_event(
+        type="on_get_tables_end",
+        data={
+            "result": ", ".join(plan.tables),
+            "tool_call_id": "GetRequiredTables",
+        },
+        config=config,
+    )
+
+    return {
+        "all_tables": plan.tables,
+        "sql_statements": plan.statements,
+        "plan_cached": True,
+    }
+
+
+def should_use_cached_plan(state: State, config: RunnableConfig = None):
+    if not state.get("plan_cached"):
+        if settings.SPECULATIVE_CORE_SUBJECT:
+            return "speculate_core_subject"
+        return "get_tables"
+
+    return should_invoke_get_core_subject(state, config)
 
 
 # Gets the table(s) information from the description_table
@@ -59,59 +110,52 @@ async def get_tables(state: State, config: RunnableConfig = None):
         config=config,
     )
 
-    c = PGConnection(settings.POSTGRES_DSN.unicode_string())
-    conn = c.get_conn()
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM description_table;")
-        colnames = [desc[0] for desc in cur.description]
-        raw_rows = cur.fetchall()
-        rows = [dict(zip(colnames, row)) for row in raw_rows]
-    conn.close()
+    # Only the descriptions of the shortlisted tables are shown to the LLM, or none when
+    # one table clearly dominates
+    table_names, markdown_table = await route_tables(user_query)
 
-    markdown_table = convert_rows_to_markdown(rows)
+    if markdown_table is not None:
+        prompt = PROMPT_GET_REQUIRED_TABLES.format(
+            user_query=user_query, table_descriptions=markdown_table
+        )
 
-    prompt = PROMPT_GET_REQUIRED_TABLES.format(
-        user_query=user_query, table_descriptions=markdown_table
-    )
+        # with open("./test/run/get_tables_prompt.md", "w") as f:
+        #     f.write(prompt)
 
-    # with open("./test/run/get_tables_prompt.md", "w") as f:
-    #     f.write(prompt)
+        messages = [HumanMessage(content=prompt)]
 
-    messages = [HumanMessage(content=prompt)]
+        model_name = config["configurable"].get("model", "gemini-2.0")
 
-    model_name = config["configurable"].get("model", "gemini-2.0")
+        m: BaseChatModel = models[model_name] | table_names_output_parser
 
-    m: BaseChatModel = models[model_name] | table_names_output_parser
-
-    response = m.invoke(messages, config)
+        response = await m.ainvoke(messages, config)
+        table_names = response["table_names"]
 
     await emit_custom_event(
         type="on_get_tables_end",
         data={
-            "result": ", ".join(response["table_names"]),
+            "result": ", ".join(table_names),
             "tool_call_id": "GetRequiredTables",
         },
         config=config,
     )
 
-    return {"all_tables": response["table_names"]}
+    return {"all_tables": table_names}
 
 
 # Given the user query and relevant tables to use, this generates the SQL queries
 # to be executed or correct the previously generated queries if there is an error
 async def generate_table_query(state: State, config: RunnableConfig = None):
-    c = PGConnection(settings.POSTGRES_DSN.unicode_string())
-    conn = c.get_conn()
     user_query: str = state["messages"][-1].content.strip()
 
     system_msg = PROMPT_GENERATE_OR_CORRECT_SQL_STATEMENT_SYS.format()
 
     all_tables = state["all_tables"]
-    all_tables_samples = "\n\n".join(
-        [
-            get_sample(cursor=conn.cursor(), table_name=table_name)
-            for table_name in all_tables
-        ]
+    model_name = config["configurable"].get("model", "gemini-2.0")
+
+    # Samples of every table, kept within the token budget of the section
+    all_tables_samples, prompt_report = await build_table_samples(
+        all_tables, user_query, model_name
     )
     human_msg = PROMPT_GENERATE_OR_CORRECT_SQL_STATEMENT_HUMAN.format(
         user_query=user_query,
@@ -120,8 +164,6 @@ async def generate_table_query(state: State, config: RunnableConfig = None):
         query_error=state.get("query_error", ""),
     )
 
-    conn.close()
-
     # with open("./test/run/generate_query_human_msg.md", "w") as f:
     #     f.write(human_msg)
 
@@ -130,8 +172,6 @@ async def generate_table_query(state: State, config: RunnableConfig = None):
 
     messages = [SystemMessage(content=system_msg), HumanMessage(content=human_msg)]
 
-    model_name = config["configurable"].get("model", "gemini-2.0")
-
     m: BaseChatModel = models[model_name] | sql_queries_output_parser
 
     response = await m.ainvoke(messages, config)
@@ -140,6 +180,15 @@ async def generate_table_query(state: State, config: RunnableConfig = None):
     #     for query in response["queries"]:
     #         f.write(query + "\n\n")
 
+    await emit_prompt_size(
+        "generate_table_query",
+        system_msg + human_msg,
+        "\n".join(response["queries"]),
+        model_name,
+        prompt_report,
+        config,
+    )
+
     return {"sql_statements": response["queries"]}
 
 
@@ -150,7 +199,7 @@ def should_invoke_get_core_subject(state: State, config: RunnableConfig = None):
         return "execute_query"
 
     for sql_statement in state["sql_statements"]:
-        if "embedding" in sql_statement:
+        if needs_embedding(sql_statement):
             return "get_core_subject"
 
     return "execute_query"
@@ -163,6 +212,23 @@ def should_invoke_get_core_subject(state: State, config: RunnableConfig = None):
 async def get_core_subject(state: State, config: RunnableConfig = None):
     user_query: str = state["messages"][-1].content.strip()
 
+    await emit_core_subject_start(user_query, config)
+    core_subject = await extract_core_subject(user_query, config)
+    await emit_core_subject_end(core_subject, config)
+
+    return {"core_subject": core_subject}
+
+
+async def extract_core_subject(user_query: str, config: RunnableConfig) -> str:
+    m: BaseChatModel = models[config["configurable"].get("model", "gemini-2.0")]
+    messages = [
+        HumanMessage(content=PROMPT_GET_THE_CORE_SUBJECT.format(user_query=user_query))
+    ]
+    response = await m.ainvoke(messages, config)
+    return response.content
+
+
+async def emit_core_subject_start(user_query: str, config: RunnableConfig):
     await emit_custom_event(
         type="on_get_core_subject_start",
         data={
@@ -172,72 +238,79 @@ async def get_core_subject(state: State, config: RunnableConfig = None):
         config=config,
     )
 
-    m: BaseChatModel = models[config["configurable"].get("model", "gemini-2.0")]
-    messages = [
-        HumanMessage(content=PROMPT_GET_THE_CORE_SUBJECT.format(user_query=user_query))
-    ]
-    response = await m.ainvoke(messages, config)
 
+async def emit_core_subject_end(core_subject: str, config: RunnableConfig):
     await emit_custom_event(
         type="on_get_core_subject_end",
         data={
-            "result": response.content,
+            "result": core_subject,
             "tool_call_id": "GetCoreSubject",
         },
         config=config,
     )
 
-    return {"core_subject": response.content}
+
+# Runs get_tables and generate_table_query while the core subject is extracted, as the
+# core subject only depends on the user query
+# The core subject is kept only if a generated statement embeds it, otherwise discarded
+# Its events are only sent once it's kept, so the client never sees a discarded step
+async def speculate_core_subject(state: State, config: RunnableConfig = None):
+    user_query: str = state["messages"][-1].content.strip()
+    core_subject_task = asyncio.create_task(extract_core_subject(user_query, config))
+
+    # The extraction never outlives the node, also when it fails or is cancelled
+    try:
+        results = await get_tables(state, config)
+        results.update(await generate_table_query({**state, **results}, config))
+        if not any(needs_embedding(s) for s in results["sql_statements"]):
+            return results
+
+        try:
+            core_subject = await core_subject_task
+        except Exception as e:
+            # Extracted again by get_core_subject if a statement needs it
+            print(f"Failed to extract the core subject: {e}")
+            return results
+    finally:
+        if not core_subject_task.done():
+            core_subject_task.cancel()
+
+    await emit_core_subject_start(user_query, config)
+    await emit_core_subject_end(core_subject, config)
+    results["core_subject"] = core_subject
+    return results
 
 
 # Executes the SQL queries and returns the results
 # If there is an error, it invokes the generate table query again with the error
 async def execute_query(state: State, config: RunnableConfig = None):
-    retriever = PGRetriever()
-    user_query: str = state["messages"][-1].content.strip()
+    question: str = state["messages"][-1].content.strip()
 
-    user_query = state.get("core_subject", user_query)
+    user_query = state.get("core_subject", question)
     results = {
         "result_langchain_docs": [],
         "query_error": "",
     }
 
     try:
-        for statement in state["sql_statements"]:
-            await emit_custom_event(
-                type="on_retriever_start",
-                data={
-                    "sql_query": statement,
-                    "user_query": user_query if "embedding" in statement else None,
-                    "tool_call_id": "PGRetriever",
-                },
-                config=config,
-            )
-
-            docs = retriever.get_relevant_documents(statement, user_query=user_query)
-            results["result_langchain_docs"].append(docs)
-
-            await emit_custom_event(
-                type="on_retriever_end",
-                data={
-                    "result": docs,
-                    "tool_call_id": "PGRetriever",
-                },
-                config=config,
-            )
-    except Exception as e:
-        await emit_custom_event(
-            type="on_retriever_error",
-            data={
-                "error": str(e),
-                "tool_call_id": "PGRetriever",
-            },
-            config=config,
+        results["result_langchain_docs"] = await execute_statements(
+            state["sql_statements"], user_query, config
         )
-
-        results = {"result_langchain_docs": "", "query_error": f"Error: {e}"}
+    except Exception as e:
+        # A reused plan that fails is corrected by the LLM and not offered again
+        if state.get("plan_cached"):
+            plan_cache.discard(state["sql_statements"])
+
+        results = {
+            "result_langchain_docs": "",
+            "query_error": f"Error: {e}",
+            "plan_cached": False,
+        }
         return results
 
+    if settings.PLAN_CACHE_ENABLED and not state.get("plan_cached"):
+        await plan_cache.store(question, state["all_tables"], state["sql_statements"])
+
     return results
 
 
@@ -253,12 +326,10 @@ async def generate_response(state: State, config: RunnableConfig = None):
     user_query = state["messages"][-1].content
     result_langchain_docs = state["result_langchain_docs"]
 
-    markdown_table = ""
+    model_name = config["configurable"].get("model", "gemini-2.0")
 
-    for docs in result_langchain_docs:
-        if markdown_table:
-            markdown_table += "\n\n"
-        markdown_table += convert_rows_to_markdown(docs)
+    # Big results are cut to their first rows plus a summary of all of them
+    markdown_table, prompt_report = build_results(result_langchain_docs, model_name)
 
     response_generation_prompt = PROMPT_GENERATE_RESPONSE_FROM_SQL.format(
         user_query=user_query,
@@ -270,11 +341,18 @@ async def generate_response(state: State, config: RunnableConfig = None):
 
     messages = [HumanMessage(response_generation_prompt)]
 
-    model_name = config["configurable"].get("model", "gemini-2.0")
-
-    m: BaseChatModel = models[model_name]
+    m: BaseChatModel = models[model_name].with_config(tags=[ANSWER_TAG])
     response = await m.ainvoke(messages, config)
 
+    await emit_prompt_size(
+        "generate_response",
+        response_generation_prompt,
+        response.content,
+        model_name,
+        prompt_report,
+        config,
+    )
+
     return {"messages": [response]}
 
 
@@ -286,7 +364,25 @@ graph_builder.add_node("execute_query", execute_query)
 graph_builder.add_node("generate_response", generate_response)
 graph_builder.add_node("get_core_subject", get_core_subject)
 
-graph_builder.add_edge(START, "get_tables")
+graph_builder.add_node("speculate_core_subject", speculate_core_subject)
+graph_builder.add_conditional_edges(
+    "speculate_core_subject",
+    should_invoke_get_core_subject,
+    {"get_core_subject": "get_core_subject", "execute_query": "execute_query"},
+)
+
+graph_builder.add_node("lookup_plan", lookup_plan)
+graph_builder.add_edge(START, "lookup_plan")
+graph_builder.add_conditional_edges(
+    "lookup_plan",
+    should_use_cached_plan,
+    {
+        "get_tables": "get_tables",
+        "speculate_core_subject": "speculate_core_subject",
+        "get_core_subject": "get_core_subject",
+        "execute_query": "execute_query",
+    },
+)
 graph_builder.add_edge("get_tables", "generate_table_query")
 graph_builder.add_conditional_edges(
     "generate_table_query",
@@ -0,0 +1,99 @@
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import settings
+from retriever.retriever import PGRetriever, pg_retriever
+
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+
+class CachedPlan:
+    def __init__(
+        self,
+        question: str,
+        vector: np.ndarray,
+        tables: List[str],
+        statements: List[str],
+    ) -> None:
+        self.question = question
+        self.vector = vector
+        self.tables = tables
+        self.statements = statements
+
+
+# Cache of SQL statements that executed without error, keyed by the question embedding
+# A question at least `threshold` similar to a cached one reuses its tables and statements,
+# only the %(embedding)s / %(query)s parameters are bound again at execution, so the
+# get_tables and generate_table_query LLM calls are skipped
+# Paraphrases with different numbers ("5% tax" vs "18% tax") embed almost identically but
+# need different SQL, so the numbers of both questions have to match as well
+# Plans depend on the schema only, they are dropped when the schema changes
+class PlanCache:
+    def __init__(
+        self,
+        retriever: PGRetriever = pg_retriever,
+        threshold: float = settings.PLAN_CACHE_THRESHOLD,
+        max_entries: int = settings.PLAN_CACHE_MAX_ENTRIES,
+    ) -> None:
+        self.retriever = retriever
+        self.threshold = threshold
+        self.max_entries = max_entries
+
+        self._plans: List[CachedPlan] = []
+        self._metrics = {"hits": 0, "misses": 0, "stored": 0, "discarded": 0}
+
+    async def lookup(self, question: str) -> Optional[CachedPlan]:
+        if self._plans:
+            vector = await self.retriever.aembed_query_array(question)
+            similarities = np.stack([p.vector for p in self._plans]) @ vector
+            numbers = NUMBER_PATTERN.findall(question)
+
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+
+                plan = self._plans[i]
+                if NUMBER_PATTERN.findall(plan.question) == numbers:
+                    self._metrics["hits"] += 1
+                    return plan
+
+        self._metrics["misses"] += 1
+        return None
+
+    async def store(
+        self, question: str, tables: List[str], statements: List[str]
+    ) -> None:
+        # A plan without tables or statements can't answer anything when reused
+        if not tables or not statements:
+            return
+
+        vector = await self.retriever.aembed_query_array(question)
+
+        self._plans = [p for p in self._plans if p.question != question]
+        self._plans.append(CachedPlan(question, vector, tables, statements))
+        del self._plans[: -self.max_entries]
+        self._metrics["stored"] += 1
+
+    # Drops the plans with these statements, e.g. after a reused plan failed
+    def discard(self, statements: List[str]) -> None:
+        plans = [p for p in self._plans if p.statements != statements]
+        self._metrics["discarded"] += len(self._plans) - len(plans)
+        self._plans = plans
+
+    # Listener callback for the schema channel
+    def on_notify(self, payload: str) -> None:
+        self._metrics["discarded"] += len(self._plans)
+        self._plans = []
+
+    def stats(self) -> Dict:
+        lookups = self._metrics["hits"] + self._metrics["misses"]
+        return {
+            **self._metrics,
+            "hit_rate": self._metrics["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._plans),
+        }
+
+
+plan_cache = PlanCache()
@@ -0,0 +1,197 @@
+import re
+from functools import lru_cache
+from numbers import Number
+from typing import Any, Dict, List, Tuple
+
+import tiktoken
+from langchain_core.runnables import RunnableConfig
+
+from agents.utils import CustomData, convert_rows_to_markdown
+from config import settings
+from database.catalog import schema_catalog
+from database.utils import render_sample_markdown
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+# gpt-4o and newer OpenAI models use o200k, the other providers don't publish their
+# tokenizer so cl100k is used as an estimate
+@lru_cache
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    if "gpt-4o" in model_name or "gpt-4.1" in model_name:
+        return tiktoken.get_encoding("o200k_base")
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    return len(get_encoding(model_name or "").encode(text, disallowed_special=()))
+
+
+def truncate_cell(value: Any, max_chars: int = settings.PROMPT_MAX_CELL_CHARS) -> Any:
+    if isinstance(value, str) and len(value) > max_chars:
+        return value[:max_chars] + "..."
+    return value
+
+
+# Columns the question mentions (by any word of their name) and the columns every query
+# needs: the id and the embedded text columns
+def _column_relevance(column: str, question_words: set) -> int:
+    if column == "id" or column.startswith("usevec_"):
+        return 2
+    return int(bool(set(WORD_PATTERN.findall(column.lower())) & question_words))
+
+
+# Schema and sample rows of one table within `budget` tokens
+# Cells are truncated first, then the columns unrelated to the question are dropped
+# (last ones first), then sample rows. Returns the markdown and the dropped columns
+def budget_table_sample(
+    table_name: str,
+    schema_rows: List[tuple],
+    sample_rows: List[tuple],
+    question: str,
+    model_name: str,
+    budget: int,
+) -> Tuple[str, List[str]]:
+    question_words = set(WORD_PATTERN.findall(question.lower()))
+    rows = [tuple(truncate_cell(v) for v in row) for row in sample_rows]
+    kept = list(range(len(schema_rows)))
+
+    def render() -> str:
+        return render_sample_markdown(
+            table_name,
+            [schema_rows[i] for i in kept],
+            [tuple(row[i] for i in kept) for row in rows],
+            len(rows),
+        )
+
+    prunable = sorted(
+        (i for i in kept if not _column_relevance(schema_rows[i][0], question_words)),
+        reverse=True,
+    )
+    markdown = render()
+    while count_tokens(markdown, model_name) > budget and (prunable or len(rows) > 1):
+        if prunable:
+            kept.remove(prunable.pop(0))
+        else:
+            rows.pop()
+        markdown = render()
+
+    dropped = [row[0] for i, row in enumerate(schema_rows) if i not in kept]
+    if dropped:
+        markdown += f"\nOmitted columns: {', '.join(dropped)}\n"
+    return markdown, dropped
+
+
+# Samples of all the tables used to generate SQL, sharing PROMPT_SAMPLES_TOKEN_BUDGET
+async def build_table_samples(
+    all_tables: List[str], question: str, model_name: str
+) -> Tuple[str, Dict[str, Any]]:
+    budget = settings.PROMPT_SAMPLES_TOKEN_BUDGET // max(len(all_tables), 1)
+
+    samples = []
+    dropped_columns = {}
+    for table_name in all_tables:
+        markdown, dropped = budget_table_sample(
+            table_name,
+            await schema_catalog.get_columns(table_name),
+            await schema_catalog.get_sample_rows(table_name),
+            question,
+            model_name,
+            budget,
+        )
+        samples.append(markdown)
+        if dropped:
+            dropped_columns[table_name] = dropped
+
+    text = "\n\n".join(samples)
+    return text, {
+        "samples_tokens": count_tokens(text, model_name),
+        "dropped_columns": dropped_columns,
+    }
+
+
+# Count and distinct values of every column and min, max, average and sum of the
+# numeric ones, over every row of a result
+def summarize_rows(rows: List[Dict]) -> List[Dict]:
+    summary = []
+    for column in rows[0].keys():
+        values = [row[column] for row in rows if row[column] is not None]
+        numbers = [
+            float(v)
+            for v in values
+            if isinstance(v, Number) and not isinstance(v, bool)
+        ]
+
+        is_numeric = bool(values) and len(numbers) == len(values)
+        summary.append(
+            {
+                "column": column,
+                "count": len(values),
+                "distinct": len(set(map(str, values))),
+                "min": min(numbers) if is_numeric else "",
+                "max": max(numbers) if is_numeric else "",
+                "avg": round(sum(numbers) / len(numbers), 4) if is_numeric else "",
+                "sum": round(sum(numbers), 4) if is_numeric else "",
+            }
+        )
+    return summary
+
+
+# Markdown of one result within `budget` tokens: all the rows when they fit, otherwise
+# the first rows that fit plus a summary of the whole result
+def budget_result(
+    rows: List[Dict], model_name: str, budget: int
+) -> Tuple[str, Dict[str, int]]:
+    rows = [{k: truncate_cell(v) for k, v in row.items()} for row in rows]
+    markdown = convert_rows_to_markdown(rows)
+    if count_tokens(markdown, model_name) <= budget:
+        return markdown, {"rows": len(rows), "shown": len(rows)}
+
+    summary = convert_rows_to_markdown(summarize_rows(rows))
+    shown = min(settings.PROMPT_RESULT_HEAD_ROWS, len(rows))
+    while True:
+        markdown = (
+            convert_rows_to_markdown(rows[:shown])
+            + f"\nShowing the first {shown} of {len(rows)} rows. Summary of all rows:\n\n"
+            + summary
+        )
+        if shown <= 1 or count_tokens(markdown, model_name) <= budget:
+            return markdown, {"rows": len(rows), "shown": shown}
+        shown //= 2
+
+
+# Results of all the statements, sharing PROMPT_RESULTS_TOKEN_BUDGET
+def build_results(
+    results: List[List[Dict]], model_name: str
+) -> Tuple[str, Dict[str, Any]]:
+    budget = settings.PROMPT_RESULTS_TOKEN_BUDGET // max(len(results), 1)
+
+    tables = []
+    sizes = []
+    for rows in results:
+        markdown, size = budget_result(rows, model_name, budget)
+        tables.append(markdown)
+        sizes.append(size)
+
+    text = "\n\n".join(tables)
+    return text, {"results_tokens": count_tokens(text, model_name), "results": sizes}
+
+
+# Reports the token size of an LLM call and what the budgets cut from its prompt
+async def emit_prompt_size(
+    node: str,
+    prompt: str,
+    response: str,
+    model_name: str,
+    report: dict,
+    config: RunnableConfig,
+):
+    await CustomData(
+        type="on_prompt_size",
+        data={
+            "node": node,
+            "prompt_tokens": count_tokens(prompt, model_name),
+            "response_tokens": count_tokens(response, model_name),
+            **report,
+        },
+    ).adispatch(config)
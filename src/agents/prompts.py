@@ -25,37 +25,10 @@ table_names_output_parser = StructuredOutputParser.from_response_schemas(
 
 SQL_QUERY_FEW_SHOT_EXAMPLES = [
     {
-        "table": "CREATE TABLE Places (PlaceID INT PRIMARY KEY, Location DECIMAL(10, 2), usevec_PlaceDescription TEXT, useembed_PlaceDescription VECTOR(1564));",
+        "table": "CREATE TABLE Places (PlaceID INT PRIMARY KEY, Location DECIMAL(10, 2), usevec_PlaceDescription TEXT, useembed_PlaceDescription VECTOR(1564), usets_PlaceDescription TSVECTOR);",
         "question": "What are the places near the river banks?",
-        "sql_query": """
-            WITH semantic_search AS (
-                SELECT PlaceID, RANK() OVER (ORDER BY useembed_PlaceDescription <=> %(embedding)s) AS rank
-                FROM Places
-                ORDER BY useembed_PlaceDescription <=> %(embedding)s
-                LIMIT %(k)s
-            ),
-            keyword_search AS (
-                SELECT PlaceID, RANK() OVER (ORDER BY ts_rank_cd(to_tsvector('english', usevec_PlaceDescription), plainto_tsquery('english', %(embedding)s)) DESC) AS rank
-                FROM Places
-                WHERE to_tsvector('english', usevec_PlaceDescription) @@ plainto_tsquery('english', %(embedding)s)
-                ORDER BY ts_rank_cd(to_tsvector('english', usevec_PlaceDescription), plainto_tsquery('english', %(embedding)s)) DESC
-                LIMIT %(k)s
-            ),
-            combined AS (
-                SELECT
-                    COALESCE(semantic_search.PlaceID, keyword_search.PlaceID) AS PlaceID,
-                    COALESCE(1.0 / (%(k)s + semantic_search.rank), 0.0) +
-                    COALESCE(1.0 / (%(k)s + keyword_search.rank), 0.0) AS score
-                FROM semantic_search
-                FULL OUTER JOIN keyword_search ON semantic_search.PlaceID = keyword_search.PlaceID
-            )
-            SELECT p.PlaceID, p.Location, p.usevec_PlaceDescription
-            FROM combined c
-            JOIN Places p ON c.PlaceID = p.PlaceID
-            ORDER BY c.score DESC
-            LIMIT %(k)s;
-        """,
-        "reason": "No explicit indicator for places near river banks; semantic + keyword fusion helps improve retrieval.",
+        "sql_query": "HYBRID_SEARCH Places.PlaceDescription RETURNING PlaceID, Location, usevec_PlaceDescription;",
+        "reason": "No explicit indicator for places near river banks; semantic + keyword fusion helps improve retrieval, so a HYBRID_SEARCH statement is returned instead of SQL.",
     },
     {
         "table": "CREATE TABLE Products (Id INT, ProductName TEXT, Price DECIMAL(10, 2));",
@@ -80,7 +53,9 @@ You are a PostgresSQL expert that generates a valid SQL query based on a natural
 - USE ONLY the <=> function for text similarity searches. Never use LIKE or ILIKE.
 - **FOR CONDITIONS BASED ON COLUMNS PREFIXED WITH `usevec_[column_name]`, ENSURE THE EMBEDDINGS COLUMN `useembed_[column_name]` IS USED IN VECTOR SIMILARITY CALCULATIONS.**
 - DO NOT READ embeddings columns, ONLY USE THEM for VECTOR SIMILARITY CALCULATIONS.
-- use only the keywords **(embedding, k) as placeholders** in the SQL query to replace the embedding and k values.
+- FOR KEYWORD + SEMANTIC SEARCH ON `usevec_[column_name]` DO NOT WRITE THE SQL, RETURN THE STATEMENT `HYBRID_SEARCH [table].[column_name] RETURNING [key column], [other columns]`. The first returned column MUST be the key of the table.
+- FOR KEYWORD MATCHES ON `usevec_[column_name]` USE ITS INDEXED TSVECTOR COLUMN `usets_[column_name]`, never call to_tsvector in the query.
+- use only the keywords **(embedding, query, k) as placeholders** in the SQL query to replace the embedding, the user question and k values.
 - ALWAYS READ THE **ID AND DESCRIPTION** COLUMNS THAT PROVIDES INFORMATION ABOUT THE FETCHED RESULTS.**
 - **ALWAYS ORDER THE FETCHED RESULTS BY THE SIMILARITY SCORE.**
 
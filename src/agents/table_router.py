@@ -0,0 +1,44 @@
+from typing import List, Optional, Tuple
+
+from config import settings
+from database.catalog import schema_catalog
+from retriever.retriever import pg_retriever
+
+
+# Pre-selects the tables for a question by similarity with their embedded descriptions,
+# so the get_tables prompt stays the same size however many tables the database has
+# Returns the shortlisted tables (at most TABLE_ROUTING_TOP_N scoring at least
+# TABLE_ROUTING_MIN_SCORE) and their descriptions rendered for the prompt
+# When the best table also leads the next one by TABLE_ROUTING_MARGIN, only that table
+# is returned, without descriptions (None): it is selected and the LLM step is skipped
+# Falls back to every description (and no tables) when routing is disabled, when a
+# table isn't embedded yet or when no table is similar enough
+async def route_tables(user_query: str) -> Tuple[Optional[List[str]], Optional[str]]:
+    if not settings.TABLE_ROUTING_ENABLED:
+        return None, await schema_catalog.get_descriptions_markdown()
+
+    vector = await pg_retriever.aembed_query_array(user_query)
+    ranked = await schema_catalog.rank_tables(vector, settings.TABLE_ROUTING_TOP_N)
+
+    shortlist = [
+        table for table, score in ranked if score >= settings.TABLE_ROUTING_MIN_SCORE
+    ]
+    if not shortlist:
+        return None, await schema_catalog.get_descriptions_markdown()
+
+    best_score = ranked[0][1]
+    runner_up_score = ranked[1][1] if len(ranked) > 1 else -1.0
+    if best_score - runner_up_score >= settings.TABLE_ROUTING_MARGIN:
+        return shortlist[:1], None
+
+    return shortlist, await schema_catalog.get_descriptions_markdown(shortlist)
+
+
+# Whether the tables of a cached plan can still be used for this question: they have to
+# be among the tables routing shortlists for it, or still be described without routing
+async def plan_tables_match(user_query: str, tables: List[str]) -> bool:
+    shortlist, _ = await route_tables(user_query)
+    if shortlist is None:
+        shortlist = [row["t_name"] for row in await schema_catalog.get_descriptions()]
+
+    return bool(tables) and set(tables) <= set(shortlist)
@@ -1,11 +1,25 @@
-from typing import Any
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
 
 from langchain_core.callbacks import adispatch_custom_event
 from langchain_core.messages import ChatMessage
 from langchain_core.runnables import RunnableConfig
 from langchain_core.runnables.config import merge_configs
+from langgraph.config import get_config
+from langgraph.constants import CONF, CONFIG_KEY_STREAM_WRITER
 from pydantic import BaseModel, Field
 
+from config import settings
+from retriever.retriever import (
+    is_hybrid_search,
+    needs_embedding,
+    parse_hybrid_search,
+    pg_retriever,
+)
+
+# Tag of the LLM call that writes the final answer, its tokens are streamed to the client
+ANSWER_TAG = "answer"
+
 
 # Given a list of rows, this converts them to a markdown table
 # LLM understands markdown better than json, as the training data is in markdown
@@ -20,6 +34,23 @@ def convert_rows_to_markdown(rows):
     return markdown
 
 
+# Writer of the "custom" stream of the running graph, None outside of a graph run
+# Read from the config the node was given, so it works on every Python version, then from
+# the run context (async nodes only see it on Python 3.11+, get_config raises outside of
+# a runnable and plain runnables have no writer)
+def get_custom_stream_writer(
+    config: RunnableConfig | None = None,
+) -> Optional[Callable[[Any], None]]:
+    writer = (config or {}).get(CONF, {}).get(CONFIG_KEY_STREAM_WRITER)
+    if writer is not None:
+        return writer
+
+    try:
+        return get_config().get(CONF, {}).get(CONFIG_KEY_STREAM_WRITER)
+    except RuntimeError:
+        return None
+
+
 # Custom event
 class CustomData(BaseModel):
     "Custom data being sent by an agent"
@@ -33,12 +64,100 @@ class CustomData(BaseModel):
     def to_langchain(self) -> ChatMessage:
         return ChatMessage(content=[self.data], role="custom")
 
+    # Written to the "custom" stream of the running graph rather than dispatched as a
+    # callback event, so the server doesn't have to consume every astream_events event
+    # Outside of a graph (no writer) it's dispatched as a custom callback event with `config`
     async def adispatch(self, config: RunnableConfig | None = None) -> None:
-        dispatch_config = RunnableConfig(
-            tags=["custom_data_dispatch"],
-        )
-        await adispatch_custom_event(
-            name=self.type,
-            data=self.data,
-            config=merge_configs(config, dispatch_config),
-        )
+        writer = get_custom_stream_writer(config)
+        if writer is None:
+            dispatch_config = RunnableConfig(
+                tags=["custom_data_dispatch"],
+            )
+            await adispatch_custom_event(
+                name=self.type,
+                data=self.data,
+                config=merge_configs(config, dispatch_config),
+            )
+            return
+
+        writer({"type": self.type, "data": self.data})
+
+
+# Runs the SQL statements of a request concurrently, each on its own pooled connection and
+# at most SQL_STATEMENT_CONCURRENCY at a time, emitting the retriever events of every one
+# The statements are independent reads, so the request takes as long as the slowest one
+# Results keep the order of the statements, the first error cancels the others (their
+# events end with a "cancelled" error) and waits until they are done
+# Every statement has its own tool call id, as their events interleave
+# HYBRID_SEARCH statements run the keyword + semantic search of PGRetriever.ahybrid_search
+async def execute_statements(
+    statements: List[str], user_query: str, config: RunnableConfig
+) -> List[List[Dict]]:
+    semaphore = asyncio.Semaphore(settings.SQL_STATEMENT_CONCURRENCY)
+
+    # Embedded once up front instead of by every statement that needs it
+    if any(needs_embedding(statement) for statement in statements):
+        await pg_retriever.aembed_query(user_query)
+
+    async def execute_statement(index: int, statement: str) -> List[Dict]:
+        tool_call_id = f"PGRetriever-{index}"
+        async with semaphore:
+            await CustomData(
+                type="on_retriever_start",
+                data={
+                    "sql_query": statement,
+                    "user_query": (user_query if needs_embedding(statement) else None),
+                    "tool_call_id": tool_call_id,
+                },
+            ).adispatch(config)
+
+            try:
+                if is_hybrid_search(statement):
+                    table_name, column, columns = parse_hybrid_search(statement)
+                    docs = await pg_retriever.ahybrid_search(
+                        table_name, column, user_query, columns
+                    )
+                else:
+                    docs = await pg_retriever.aget_relevant_documents(
+                        statement, user_query=user_query
+                    )
+            except Exception as e:
+                await CustomData(
+                    type="on_retriever_error",
+                    data={
+                        "error": str(e),
+                        "tool_call_id": tool_call_id,
+                    },
+                ).adispatch(config)
+                raise
+            except asyncio.CancelledError:
+                # Another statement failed, the client still gets an end to this one
+                await CustomData(
+                    type="on_retriever_error",
+                    data={
+                        "error": "cancelled",
+                        "tool_call_id": tool_call_id,
+                    },
+                ).adispatch(config)
+                raise
+
+            await CustomData(
+                type="on_retriever_end",
+                data={
+                    "result": docs,
+                    "tool_call_id": tool_call_id,
+                },
+            ).adispatch(config)
+            return docs
+
+    tasks = [
+        asyncio.ensure_future(execute_statement(i, statement))
+        for i, statement in enumerate(statements)
+    ]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Waits for the cancelled statements to give their connection back
+        await asyncio.gather(*tasks, return_exceptions=True)
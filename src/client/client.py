@@ -21,7 +21,8 @@ class Client:
         }
 
     # Send a message to the server and stream the response
-    # response is a stream of ChatMessages or strings
+    # response is a stream of ChatMessages or strings, the strings are tokens of the answer
+    # when stream_tokens is set
     async def astream(
         self,
         message: str,
@@ -44,9 +45,12 @@ class Client:
                 json=request.model_dump(),
                 headers=self.headers,
             ) as response:
+                # 503 / 429 from the admission control say when to retry
                 if response.status_code != 200:
+                    retry_after = response.headers.get("retry-after")
                     raise Exception(
                         f"Error: {response.status_code} - {await response.aread()}"
+                        + (f", retry after {retry_after}s" if retry_after else "")
                     )
 
                 async for line in response.aiter_lines():
@@ -76,6 +80,8 @@ class Client:
                     f"Error JSON parsing message from server: {e}, raw data: {line}"
                 )
 
+            if parsed["status"] and parsed.get("type") == "token":
+                return parsed["data"]
             if parsed["status"]:
                 return ChatMessage.model_validate(parsed["data"])
             else:
@@ -0,0 +1,198 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from psycopg2.errors import UndefinedColumn
+
+from agents.utils import convert_rows_to_markdown
+from database.pool import PGPool, pg_pool
+from database.utils import (
+    SCHEMA_ROWS_QUERY,
+    filter_hidden_columns,
+    render_sample_markdown,
+    sample_rows_query,
+)
+
+
+# In-process cache of everything the agents need to know about the schema:
+# the description_table rows, the column metadata and the rendered samples of each table
+# Entries stay valid until the schema version is bumped, either explicitly or by a
+# NOTIFY on settings.SCHEMA_CATALOG_CHANNEL (see db_scripts/schema_notify.sql)
+class SchemaCatalog:
+    def __init__(self, pool: PGPool = pg_pool, sample_limit: int = 5) -> None:
+        self.pool = pool
+        self.sample_limit = sample_limit
+        self.version = 0
+
+        self._descriptions: Optional[List[Dict]] = None
+        self._descriptions_md: Optional[str] = None
+        self._columns: Dict[str, List[tuple]] = {}
+        self._sample_rows: Dict[str, List[tuple]] = {}
+        self._samples_md: Dict[str, str] = {}
+        # Table names and unit-length description vectors, used to route questions
+        self._table_vectors: Optional[Tuple[List[str], np.ndarray]] = None
+
+        self._metrics = {"hits": 0, "misses": 0, "refreshes": 0}
+
+    # Drops every cached entry, the next lookup reloads from the database
+    def bump_version(self) -> int:
+        self.version += 1
+        self._descriptions = None
+        self._descriptions_md = None
+        self._columns = {}
+        self._sample_rows = {}
+        self._samples_md = {}
+        self._table_vectors = None
+        self._metrics["refreshes"] += 1
+        return self.version
+
+    # Listener callback for the schema channel
+    def on_notify(self, payload: str) -> None:
+        self.bump_version()
+
+    async def get_descriptions(self) -> List[Dict]:
+        if self._descriptions is not None:
+            self._metrics["hits"] += 1
+            return self._descriptions
+
+        self._metrics["misses"] += 1
+        version = self.version
+        async with self.pool.connection() as conn:
+            rows = await conn.fetch(
+                "SELECT id, t_name, description FROM description_table;"
+            )
+
+        # Don't store a result that was loaded before a concurrent version bump
+        if version == self.version:
+            self._descriptions = rows
+        return rows
+
+    # description_table rendered as markdown, as used in PROMPT_GET_REQUIRED_TABLES
+    # Only the rows of `tables` are rendered when given
+    async def get_descriptions_markdown(
+        self, tables: Optional[List[str]] = None
+    ) -> str:
+        if tables is not None:
+            rows = await self.get_descriptions()
+            return convert_rows_to_markdown([r for r in rows if r["t_name"] in tables])
+
+        if self._descriptions_md is not None:
+            self._metrics["hits"] += 1
+            return self._descriptions_md
+
+        version = self.version
+        markdown = convert_rows_to_markdown(await self.get_descriptions())
+        if version == self.version:
+            self._descriptions_md = markdown
+        return markdown
+
+    # The useembed_description vectors written by process_db
+    # Empty while any described table has no vector yet, the tables can't be ranked then
+    async def get_table_vectors(self) -> Tuple[List[str], np.ndarray]:
+        if self._table_vectors is not None:
+            self._metrics["hits"] += 1
+            return self._table_vectors
+
+        self._metrics["misses"] += 1
+        version = self.version
+        try:
+            async with self.pool.connection() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT t_name, useembed_description::text AS embedding
+                    FROM description_table;
+                    """
+                )
+        except UndefinedColumn:
+            rows = []
+
+        if any(row["embedding"] is None for row in rows):
+            rows = []
+
+        names = [row["t_name"] for row in rows]
+        vectors = np.asarray(
+            [json.loads(row["embedding"]) for row in rows], dtype=np.float32
+        )
+        if len(rows):
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms > 0, norms, 1.0)
+
+        if version == self.version:
+            self._table_vectors = (names, vectors)
+        return names, vectors
+
+    # Tables ranked by the similarity of their description with the (unit-length) question
+    async def rank_tables(
+        self, vector: np.ndarray, top_n: int
+    ) -> List[Tuple[str, float]]:
+        names, vectors = await self.get_table_vectors()
+        if not names:
+            return []
+
+        similarities = vectors @ vector
+        best = np.argsort(-similarities)[:top_n]
+        return [(names[i], float(similarities[i])) for i in best]
+
+    async def _load_table(self, table_name: str) -> Dict[str, Any]:
+        version = self.version
+        async with self.pool.connection() as conn:
+            _, schema_rows = await conn.fetch_rows(SCHEMA_ROWS_QUERY, (table_name,))
+            schema_rows = filter_hidden_columns(schema_rows)
+            _, sample_rows = await conn.fetch_rows(
+                sample_rows_query(table_name, [row[0] for row in schema_rows]),
+                (self.sample_limit,),
+            )
+
+        entry = {
+            "columns": schema_rows,
+            "sample_rows": sample_rows,
+            "sample_md": render_sample_markdown(
+                table_name, schema_rows, sample_rows, self.sample_limit
+            ),
+        }
+
+        if version == self.version:
+            self._columns[table_name] = entry["columns"]
+            self._sample_rows[table_name] = entry["sample_rows"]
+            self._samples_md[table_name] = entry["sample_md"]
+        return entry
+
+    async def get_columns(self, table_name: str) -> List[tuple]:
+        if table_name in self._columns:
+            self._metrics["hits"] += 1
+            return self._columns[table_name]
+
+        self._metrics["misses"] += 1
+        return (await self._load_table(table_name))["columns"]
+
+    async def get_sample_rows(self, table_name: str) -> List[tuple]:
+        if table_name in self._sample_rows:
+            self._metrics["hits"] += 1
+            return self._sample_rows[table_name]
+
+        self._metrics["misses"] += 1
+        return (await self._load_table(table_name))["sample_rows"]
+
+    # Same output as database.utils.get_sample, without touching the database when warm
+    async def get_sample(self, table_name: str) -> str:
+        if table_name in self._samples_md:
+            self._metrics["hits"] += 1
+            return self._samples_md[table_name]
+
+        self._metrics["misses"] += 1
+        return (await self._load_table(table_name))["sample_md"]
+
+    # Loads the descriptions and the samples of every described table
+    async def load(self) -> None:
+        for row in await self.get_descriptions():
+            await self._load_table(row["t_name"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "tables": len(self._samples_md),
+            **self._metrics,
+        }
+
+
+schema_catalog = SchemaCatalog()
@@ -7,14 +7,13 @@ from config import settings
 class PGConnection:
     def __init__(self, dsn=settings.POSTGRES_DSN.unicode_string()) -> None:
         self.dsn = dsn
-        self.check_connection()
         self.conn = psycopg2.connect(self.dsn)
+        self.check_connection()
 
+    # Verifies the connection that was just opened instead of opening a second one
     def check_connection(self) -> None:
         try:
-            conn = psycopg2.connect(self.dsn)
-            conn.cursor()
-            conn.close()
+            self.conn.cursor().close()
         except Exception as e:
             print(e)
 
@@ -0,0 +1,269 @@
+import argparse
+import hashlib
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from psycopg2.extensions import connection, cursor
+
+from config import settings
+from database.connection import PGConnection
+from database.utils import get_tables
+
+# pgvector can't index vector columns with more dimensions than this
+MAX_INDEXED_DIM = 2000
+
+# Postgres silently truncates longer identifiers
+MAX_IDENTIFIER_BYTES = 63
+
+
+# Gets the useembed_ vector columns of a table with their dimension
+def get_vector_columns(cursor: cursor, table_name: str) -> List[Tuple[str, int]]:
+    cursor.execute(
+        """
+        SELECT a.attname, a.atttypmod
+        FROM pg_attribute a
+        JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = %s::regclass
+            AND t.typname = 'vector'
+            AND a.attname LIKE 'useembed\\_%%'
+            AND NOT a.attisdropped
+        ORDER BY a.attnum;
+        """,
+        (table_name,),
+    )
+    return cursor.fetchall()
+
+
+# Estimated row count from the planner statistics, counted when the table was never analyzed
+def get_row_count(cursor: cursor, table_name: str) -> int:
+    cursor.execute(
+        "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass;",
+        (table_name,),
+    )
+    rows = cursor.fetchone()[0]
+    if rows < 0:
+        cursor.execute(f"SELECT count(*) FROM {table_name};")
+        rows = cursor.fetchone()[0]
+    return rows
+
+
+# Picks the index type and build parameters from the size of the data
+# HNSW is preferred (better recall, no training step), but its graph has to fit in
+# maintenance_work_mem to build in reasonable time, so very large columns use IVFFlat
+def choose_index_params(rows: int, dim: int) -> Dict[str, Any]:
+    method = settings.ANN_INDEX_METHOD
+    if method == "auto":
+        fits_in_memory = rows * dim * 4 <= settings.ANN_HNSW_MAX_BUILD_BYTES
+        method = "hnsw" if fits_in_memory else "ivfflat"
+
+    if method == "hnsw":
+        large = rows >= 1_000_000
+        return {
+            "method": "hnsw",
+            "m": 24 if large else 16,
+            "ef_construction": 128 if large else 64,
+        }
+
+    # pgvector's guideline: rows / 1000 lists up to 1M rows, sqrt(rows) after that
+    lists = rows // 1000 if rows <= 1_000_000 else int(math.sqrt(rows))
+    return {"method": "ivfflat", "lists": max(lists, 1)}
+
+
+# Index names as Postgres stores them, folded to lower case and at most 63 bytes
+# Names that would be truncated keep a prefix and a hash of the full name, so they stay
+# unique and the name used to look an index up is the one it was created with
+def index_name(table_name: str, column: str, suffix: str = "ann_idx") -> str:
+    name = f"{table_name}_{column}_{suffix}".lower()
+    if len(name.encode()) <= MAX_IDENTIFIER_BYTES:
+        return name
+
+    digest = hashlib.sha1(name.encode()).hexdigest()[:8]
+    keep = MAX_IDENTIFIER_BYTES - len(suffix) - len(digest) - 2
+    prefix = name.encode()[:keep].decode(errors="ignore")
+    return f"{prefix}_{digest}_{suffix}"
+
+
+# Reads the type and build parameters of an existing index
+def get_index_params(cursor: cursor, name: str) -> Optional[Dict[str, Any]]:
+    cursor.execute(
+        """
+        SELECT am.amname, i.indisvalid, c.reloptions
+        FROM pg_class c
+        JOIN pg_am am ON am.oid = c.relam
+        JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = %s;
+        """,
+        (name,),
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+
+    params: Dict[str, Any] = {"method": row[0], "valid": row[1]}
+    for option in row[2] or []:
+        key, value = option.split("=", 1)
+        params[key] = int(value)
+    return params
+
+
+# An IVFFlat index is only rebuilt once the ideal number of lists drifted by more than 2x
+# Invalid indexes are left behind by an interrupted CREATE INDEX CONCURRENTLY
+def needs_rebuild(current: Dict[str, Any], wanted: Dict[str, Any]) -> bool:
+    if not current["valid"] or current["method"] != wanted["method"]:
+        return True
+
+    if wanted["method"] == "ivfflat":
+        lists = current.get("lists", 100)
+        return not (wanted["lists"] / 2 <= lists <= wanted["lists"] * 2)
+
+    return any(current.get(key) != value for key, value in wanted.items())
+
+
+def _create_index_sql(table_name: str, column: str, name: str, params: Dict) -> str:
+    options = ", ".join(f"{k} = {v}" for k, v in params.items() if k != "method")
+    return (
+        f"CREATE INDEX CONCURRENTLY {name} ON {table_name} "
+        f"USING {params['method']} ({column} vector_cosine_ops) WITH ({options});"
+    )
+
+
+# Creates or rebuilds the ANN index of one vector column and reports what was done
+def ensure_vector_index(
+    cursor: cursor, table_name: str, column: str, dim: int
+) -> Dict[str, Any]:
+    name = index_name(table_name, column)
+    report: Dict[str, Any] = {"table": table_name, "column": column, "index": name}
+
+    if dim > MAX_INDEXED_DIM:
+        report["action"] = f"skipped, {dim} dimensions can't be indexed"
+        return report
+
+    rows = get_row_count(cursor, table_name)
+    wanted = choose_index_params(rows, dim)
+    current = get_index_params(cursor, name)
+    report.update({"rows": rows, "params": wanted})
+
+    if current is not None and not needs_rebuild(current, wanted):
+        report["action"] = "up to date"
+    else:
+        cursor.execute(
+            "SET maintenance_work_mem = %s;", (settings.ANN_MAINTENANCE_WORK_MEM,)
+        )
+        started = time.perf_counter()
+
+        if current is None:
+            cursor.execute(_create_index_sql(table_name, column, name, wanted))
+            report["action"] = "created"
+        else:
+            # Build the new index next to the old one so queries never lose it
+            new_name = index_name(table_name, column, "ann_new")
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {new_name};")
+            cursor.execute(_create_index_sql(table_name, column, new_name, wanted))
+            cursor.execute(f"DROP INDEX CONCURRENTLY {name};")
+            cursor.execute(f"ALTER INDEX {new_name} RENAME TO {name};")
+            report["action"] = f"rebuilt, was {current}"
+
+        report["build_seconds"] = round(time.perf_counter() - started, 2)
+
+    cursor.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass));", (name,))
+    report["size"] = cursor.fetchone()[0]
+    return report
+
+
+# Gets the generated usets_ tsvector columns of a table
+def get_tsvector_columns(cursor: cursor, table_name: str) -> List[str]:
+    cursor.execute(
+        """
+        SELECT a.attname
+        FROM pg_attribute a
+        JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = %s::regclass
+            AND t.typname = 'tsvector'
+            AND a.attname LIKE 'usets\\_%%'
+            AND NOT a.attisdropped
+        ORDER BY a.attnum;
+        """,
+        (table_name,),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+# Creates the GIN index of one tsvector column, GIN has no parameters that depend on the data
+def ensure_text_index(cursor: cursor, table_name: str, column: str) -> Dict[str, Any]:
+    name = index_name(table_name, column, "fts_idx")
+    report: Dict[str, Any] = {"table": table_name, "column": column, "index": name}
+
+    current = get_index_params(cursor, name)
+    if current is not None and current["valid"]:
+        report["action"] = "up to date"
+    else:
+        started = time.perf_counter()
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        cursor.execute(
+            f"CREATE INDEX CONCURRENTLY {name} ON {table_name} USING gin ({column});"
+        )
+        report["action"] = "created"
+        report["build_seconds"] = round(time.perf_counter() - started, 2)
+
+    cursor.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass));", (name,))
+    report["size"] = cursor.fetchone()[0]
+    return report
+
+
+# Makes sure every useembed_ column of the tables has an up to date ANN index
+# and every usets_ column a GIN index
+# CREATE INDEX CONCURRENTLY can't run in a transaction, so the connection is
+# switched to autocommit for the duration
+def ensure_vector_indexes(
+    conn: connection, table_names: List[str]
+) -> List[Dict[str, Any]]:
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+
+    reports = []
+    try:
+        with conn.cursor() as cur:
+            for table_name in table_names:
+                for column, dim in get_vector_columns(cur, table_name):
+                    report = ensure_vector_index(cur, table_name, column, dim)
+                    print_index_report(report)
+                    reports.append(report)
+                for column in get_tsvector_columns(cur, table_name):
+                    report = ensure_text_index(cur, table_name, column)
+                    print_index_report(report)
+                    reports.append(report)
+    finally:
+        conn.autocommit = autocommit
+
+    return reports
+
+
+def print_index_report(report: Dict[str, Any]) -> None:
+    details = ", ".join(
+        f"{key}: {report[key]}"
+        for key in ("rows", "params", "build_seconds", "size")
+        if key in report
+    )
+    print(
+        f"{report['index']}: {report['action']}" + (f" ({details})" if details else "")
+    )
+
+
+# Maintenance command, checks the indexes of the given tables (all tables by default)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create and maintain ANN and full-text indexes"
+    )
+    parser.add_argument("tables", nargs="*", help="Tables to check")
+    args = parser.parse_args()
+
+    c = PGConnection(settings.POSTGRES_DSN.unicode_string())
+    conn = c.get_conn()
+
+    with conn.cursor() as cur:
+        tables = args.tables or get_tables(cur)
+
+    ensure_vector_indexes(conn, tables)
+    conn.close()
@@ -0,0 +1,104 @@
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+import psycopg2
+from psycopg2.extensions import connection
+
+from config import settings
+
+
+# Listens for Postgres NOTIFY messages on a dedicated connection and fans them out to callbacks
+# The socket is watched by the event loop, so no thread is parked waiting for notifications
+class PGListener:
+    def __init__(
+        self,
+        dsn: str = settings.POSTGRES_DSN.unicode_string(),
+        reconnect_delay: float = 5.0,
+    ) -> None:
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+
+        self._callbacks: Dict[str, List[Callable[[str], None]]] = {}
+        self._conn: Optional[connection] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._stopped = True
+
+    # The callback receives the NOTIFY payload
+    # an empty payload means "something may have changed", e.g. after a reconnect
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> None:
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def _connect(self) -> connection:
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            for channel in self._callbacks:
+                cur.execute(f'LISTEN "{channel}";')
+        return conn
+
+    def _dispatch(self, channel: str, payload: str) -> None:
+        for callback in self._callbacks.get(channel, []):
+            try:
+                callback(payload)
+            except Exception as e:
+                print(f"Listener callback for {channel} failed: {e}")
+
+    def _on_readable(self) -> None:
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            print(f"Lost the LISTEN connection: {e}")
+            self._drop_connection()
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+            return
+
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            self._dispatch(notify.channel, notify.payload)
+
+    def _drop_connection(self) -> None:
+        if self._conn is None:
+            return
+        try:
+            self._loop.remove_reader(self._conn.fileno())
+        except Exception:
+            pass
+        try:
+            self._conn.close()
+        except psycopg2.Error:
+            pass
+        self._conn = None
+
+    async def _reconnect(self) -> None:
+        while not self._stopped:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self.start()
+            except psycopg2.Error as e:
+                print(f"Reconnecting the LISTEN connection failed: {e}")
+                continue
+
+            # Notifications sent while we were away are lost, tell everyone to refresh
+            for channel in self._callbacks:
+                self._dispatch(channel, "")
+            return
+
+    async def start(self) -> None:
+        if self._conn is not None or not self._callbacks:
+            return
+
+        self._stopped = False
+        self._loop = asyncio.get_running_loop()
+        self._conn = await asyncio.to_thread(self._connect)
+        self._loop.add_reader(self._conn.fileno(), self._on_readable)
+
+    async def stop(self) -> None:
+        self._stopped = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        self._drop_connection()
+
+
+pg_listener = PGListener()
@@ -0,0 +1,281 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE, connection
+
+from config import settings
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Waits until an asynchronous psycopg2 connection finished its current operation,
+# suspending on the socket instead of blocking the event loop
+async def wait_ready(conn: connection) -> None:
+    loop = asyncio.get_running_loop()
+    fd = conn.fileno()
+
+    while True:
+        state = conn.poll()
+        if state == POLL_OK:
+            return
+
+        ready = loop.create_future()
+
+        def wake() -> None:
+            if not ready.done():
+                ready.set_result(None)
+
+        if state == POLL_READ:
+            loop.add_reader(fd, wake)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fd)
+        elif state == POLL_WRITE:
+            loop.add_writer(fd, wake)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError(f"Unexpected poll() state {state}")
+
+
+# A connection checked out from the pool
+# Connections are opened in psycopg2's asynchronous mode, every query is sent without
+# blocking and awaited on the socket, so no thread is held while Postgres works
+class PooledConnection:
+    def __init__(self, conn: connection) -> None:
+        self.conn = conn
+        # Set while a query is in flight, a connection released in that state (the task
+        # was cancelled) can't be reused
+        self.busy = False
+
+    async def fetch_rows(
+        self, query: str, params: Any = None
+    ) -> Tuple[List[str], List[tuple]]:
+        self.busy = True
+        cur = self.conn.cursor()
+        try:
+            cur.execute(query, params)
+            await wait_ready(self.conn)
+            self.busy = False
+
+            if cur.description is None:
+                return [], []
+            colnames = [desc[0] for desc in cur.description]
+            return colnames, cur.fetchall()
+        except psycopg2.Error:
+            self.busy = False
+            raise
+        finally:
+            cur.close()
+
+    async def fetch(self, query: str, params: Any = None) -> List[Dict]:
+        colnames, rows = await self.fetch_rows(query, params)
+        return [dict(zip(colnames, row)) for row in rows]
+
+    async def execute(self, query: str, params: Any = None) -> None:
+        await self.fetch_rows(query, params)
+
+
+# Process-wide pool of autocommit connections shared by the agents and the retriever
+# Connections are reused (LIFO) and only health-checked after sitting idle for a while,
+# so the TCP + auth handshake is paid once per connection instead of once per tool call
+class PGPool:
+    def __init__(
+        self,
+        dsn: str = settings.POSTGRES_DSN.unicode_string(),
+        min_size: int = settings.PG_POOL_MIN_SIZE,
+        max_size: int = settings.PG_POOL_MAX_SIZE,
+        acquire_timeout: float = settings.PG_POOL_ACQUIRE_TIMEOUT,
+        health_check_interval: float = settings.PG_POOL_HEALTH_CHECK_INTERVAL,
+    ) -> None:
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle: deque[Tuple[connection, float]] = deque()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+
+        self._metrics = {
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "acquired": 0,
+            "acquire_timeouts": 0,
+            "health_check_failures": 0,
+            "wait_time_total": 0.0,
+        }
+
+    # The semaphore belongs to an event loop, recreate it if the pool is used from a new one
+    def _get_slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_size)
+        return self._slots
+
+    # Asynchronous connections are always in autocommit mode
+    async def _connect(self) -> connection:
+        # Search-time knobs of the ANN indexes, ignored by tables without one
+        conn = psycopg2.connect(
+            self.dsn,
+            async_=True,
+            options=(
+                f"-c ivfflat.probes={settings.ANN_IVFFLAT_PROBES} "
+                f"-c hnsw.ef_search={settings.ANN_HNSW_EF_SEARCH}"
+            ),
+        )
+        try:
+            await wait_ready(conn)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    async def _is_healthy(self, conn: connection) -> bool:
+        try:
+            await PooledConnection(conn).execute("SELECT 1;")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn: connection) -> None:
+        self._size -= 1
+        self._metrics["connections_discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    async def _checkout(self) -> connection:
+        while self._idle:
+            conn, last_used = self._idle.pop()
+            if conn.closed:
+                self._discard(conn)
+                continue
+
+            idle_for = time.monotonic() - last_used
+            if idle_for > self.health_check_interval and not await self._is_healthy(
+                conn
+            ):
+                self._metrics["health_check_failures"] += 1
+                self._discard(conn)
+                continue
+
+            return conn
+
+        conn = await self._connect()
+        self._size += 1
+        self._metrics["connections_created"] += 1
+        return conn
+
+    async def _acquire(self, timeout: float) -> connection:
+        slots = self._get_slots()
+        started = time.monotonic()
+
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self._metrics["acquire_timeouts"] += 1
+            raise PoolTimeout(
+                f"Timed out after {timeout}s waiting for a database connection "
+                f"(pool size {self._size}/{self.max_size})"
+            )
+        finally:
+            self._waiting -= 1
+
+        self._metrics["wait_time_total"] += time.monotonic() - started
+
+        try:
+            conn = await self._checkout()
+        except BaseException:
+            slots.release()
+            raise
+
+        self._in_use += 1
+        self._metrics["acquired"] += 1
+        return conn
+
+    # `busy` connections were interrupted in the middle of a query, their result would be
+    # read by the next user, so the query is cancelled and the connection dropped
+    async def _release(self, conn: connection, busy: bool = False) -> None:
+        if busy and not conn.closed:
+            try:
+                await asyncio.to_thread(conn.cancel)
+            except psycopg2.Error:
+                pass
+
+        if busy or conn.closed:
+            self._discard(conn)
+        else:
+            self._idle.append((conn, time.monotonic()))
+
+        self._in_use -= 1
+        self._get_slots().release()
+
+    # Checks out a connection, waiting at most `timeout` seconds for a free slot
+    @asynccontextmanager
+    async def connection(
+        self, timeout: Optional[float] = None
+    ) -> AsyncIterator[PooledConnection]:
+        conn = await self._acquire(self.acquire_timeout if timeout is None else timeout)
+        pooled = PooledConnection(conn)
+        try:
+            yield pooled
+        finally:
+            await self._release(conn, pooled.busy)
+
+    # Opens `min_size` connections up front so the first requests don't pay for the handshake
+    async def open(self) -> None:
+        missing = self.min_size - self._size
+        if missing <= 0:
+            return
+
+        conns = await asyncio.gather(
+            *[self._acquire(self.acquire_timeout) for _ in range(missing)]
+        )
+        for conn in conns:
+            await self._release(conn)
+
+    async def close(self) -> None:
+        while self._idle:
+            conn, _ = self._idle.pop()
+            self._discard(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        acquired = self._metrics["acquired"]
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "in_use": self._in_use,
+            "waiting": self._waiting,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "connections_created": self._metrics["connections_created"],
+            "connections_discarded": self._metrics["connections_discarded"],
+            "acquired": acquired,
+            "acquire_timeouts": self._metrics["acquire_timeouts"],
+            "health_check_failures": self._metrics["health_check_failures"],
+            "avg_wait_ms": (
+                round(self._metrics["wait_time_total"] / acquired * 1000, 3)
+                if acquired
+                else 0.0
+            ),
+        }
+
+
+pg_pool = PGPool()
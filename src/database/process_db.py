@@ -1,5 +1,8 @@
+import argparse
+import asyncio
 import json
-from typing import List
+import time
+from typing import Any, Callable, Dict, List, Tuple
 
 from langchain_core.messages import HumanMessage
 from psycopg2.extensions import connection, cursor
@@ -7,17 +10,41 @@ from psycopg2.extensions import connection, cursor
 from agents.models import models
 from config import settings
 from database.connection import PGConnection
+from database.indexes import ensure_vector_indexes
 from database.utils import (
     PROMPT_GET_TABLE_DESCRIPTION,
+    copy_embeddings,
+    get_column_names,
     get_columns,
     get_sample,
+    get_schema_rows,
     get_tables,
 )
+from embedder.base import BaseEmbedder
+from embedder.cache import CachedEmbedder
 from embedder.openai_embedder import AzureOpenAIEmbedder
 
 
+# Opens a connection in a worker thread, psycopg2 connects synchronously
+async def connect() -> connection:
+    c = await asyncio.to_thread(PGConnection, settings.POSTGRES_DSN.unicode_string())
+    return c.get_conn()
+
+
+# Runs a blocking call on a connection in a worker thread
+# The thread can't be interrupted, so a cancelled caller still waits for the call to
+# return before the cancellation goes on and the connection may be closed
+async def run_on_connection(func: Callable[..., Any], *args: Any) -> Any:
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
 # Given the sample data of a table, this generates a description of the table using an LLM
-def get_table_description(table_name: str, sample: str):
+async def get_table_description(table_name: str, sample: str):
     model = models["azure-gpt-4o"]
 
     prompt = PROMPT_GET_TABLE_DESCRIPTION.format(
@@ -27,97 +54,449 @@ def get_table_description(table_name: str, sample: str):
 
     messages = [HumanMessage(content=prompt)]
 
-    response = model.invoke(messages)
+    response = await model.ainvoke(messages)
 
     return response.content
 
 
-# The chosen text columns will be embedding into vectors and will be inserted into a new corresponding column
-# The existing columns will be renamed to usevec_[col] and the new column will be useembed_[col]
-def embedd_text_columns_and_add_description(
-    conn: connection, cursor: cursor, table_name: str, columns: List[str]
-) -> None:
-    embedder = AzureOpenAIEmbedder()
+# Renames [col] to usevec_[col] and adds the useembed_[col], usehash_[col] and usets_[col] columns
+# Safe to call again on a column that was already onboarded, returns True if it is new
+def prepare_embedding_columns(
+    cursor: cursor, table_name: str, column: str, dim: int
+) -> bool:
+    is_new = f"usevec_{column}" not in get_column_names(cursor, table_name)
 
-    for column in columns:
-        cursor.execute(f"SELECT id, {column} FROM {table_name};")
-        rows = cursor.fetchall()  # List of tuples: (id, column_value)
-
-        ids = [row[0] for row in rows]
-        column_values = [row[1] for row in rows]
-
-        try:
-            embeddings = embedder.embed_chunks(column_values)
-        except Exception as e:
-            print(f"Failed to embed column {column}: {e}")
-            continue
-
-        # Rename the original column
+    # Rename the original column
+    if is_new:
         cursor.execute(
             f"""
             ALTER TABLE {table_name} RENAME {column} TO usevec_{column};
         """
         )
 
-        # Add a new column for the embedding
-        cursor.execute(
-            f"""
-            ALTER TABLE {table_name} ADD COLUMN useembed_{column} vector({embedder.get_dim()});
-        """
+    # Add a new column for the embedding, one for the hash of the embedded text and a
+    # generated tsvector for keyword search, kept in sync with the text by Postgres
+    cursor.execute(
+        f"""
+        ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS useembed_{column} vector({dim});
+        ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS usehash_{column} TEXT;
+        ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS usets_{column} tsvector
+            GENERATED ALWAYS AS (to_tsvector('english', coalesce(usevec_{column}, ''))) STORED;
+    """
+    )
+
+    return is_new
+
+
+# Fetches the next rows that were never embedded or whose text changed since they were
+def fetch_stale_rows(
+    cursor: cursor,
+    table_name: str,
+    column: str,
+    after_id: Any,
+    batch_size: int,
+) -> List[tuple]:
+    after = "AND id > %(after_id)s" if after_id is not None else ""
+    cursor.execute(
+        f"""
+        SELECT id, usevec_{column}, md5(coalesce(usevec_{column}, ''))
+        FROM {table_name}
+        WHERE (
+            useembed_{column} IS NULL
+            OR usehash_{column} IS DISTINCT FROM md5(coalesce(usevec_{column}, ''))
+        ) {after}
+        ORDER BY id
+        LIMIT %(batch_size)s;
+    """,
+        {"after_id": after_id, "batch_size": batch_size},
+    )
+    return cursor.fetchall()  # List of tuples: (id, column_value, content_hash)
+
+
+# Rows and busy time of one pipeline stage
+class StageStats:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.rows = 0
+        self.seconds = 0.0
+
+    def record(self, rows: int, started: float) -> None:
+        self.rows += rows
+        self.seconds += time.perf_counter() - started
+
+    def __str__(self) -> str:
+        rate = self.rows / self.seconds if self.seconds else 0.0
+        return (
+            f"{self.name}: {self.rows} rows in {self.seconds:.1f}s ({rate:.0f} rows/s)"
         )
 
-        # Update the embedding column row by row using the ID
-        for row_id, embedding in zip(ids, embeddings):
-            cursor.execute(
-                f"""
-                UPDATE {table_name}
-                SET useembed_{column} = %s
-                WHERE id = %s;
-            """,
-                (json.dumps(embedding), row_id),
+
+# Embeds the new and changed rows of a column with three overlapping stages:
+# fetch (keyset-paginated reads), embed (concurrent provider calls) and write (COPY + commit)
+# connected by bounded queues, so reading, embedding and writing happen at the same time
+# Every written batch is committed, the committed hashes are the checkpoint a crashed run
+# resumes from
+async def embed_column(
+    table_name: str,
+    column: str,
+    embedder: BaseEmbedder,
+    batch_size: int = settings.PROCESS_DB_BATCH_SIZE,
+    queue_size: int = settings.PROCESS_DB_QUEUE_SIZE,
+    embed_workers: int = settings.PROCESS_DB_EMBED_WORKERS,
+) -> Tuple[int, List[StageStats]]:
+    fetch_stats = StageStats("fetch")
+    embed_stats = StageStats("embed")
+    write_stats = StageStats("write")
+
+    fetched: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    embedded: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    read_conn = await connect()
+    read_conn.autocommit = True
+    try:
+        write_conn = await connect()
+    except BaseException:
+        read_conn.close()
+        raise
+
+    async def fetch() -> None:
+        after_id = None
+        with read_conn.cursor() as cur:
+            while True:
+                started = time.perf_counter()
+                rows = await run_on_connection(
+                    fetch_stale_rows, cur, table_name, column, after_id, batch_size
+                )
+                if not rows:
+                    break
+                fetch_stats.record(len(rows), started)
+
+                await fetched.put(rows)
+                after_id = rows[-1][0]
+
+        for _ in range(embed_workers):
+            await fetched.put(None)
+
+    async def embed() -> None:
+        while (rows := await fetched.get()) is not None:
+            started = time.perf_counter()
+            embeddings = await embedder.aembed_chunks([row[1] for row in rows])
+            embed_stats.record(len(rows), started)
+
+            await embedded.put((rows, embeddings))
+
+        await embedded.put(None)
+
+    def write_batch(rows: List[tuple], embeddings: List[List[float]]) -> int:
+        with write_conn.cursor() as cur:
+            # Stream the embeddings in with COPY and apply them in one UPDATE
+            updated = copy_embeddings(
+                cur,
+                table_name,
+                column,
+                [row[0] for row in rows],
+                embeddings,
+                hashes=[row[2] for row in rows],
             )
+        write_conn.commit()
+        return updated
 
-        print()
-        print(f"For column: {column}")
-        print(f"Changed column name to usevec_{column}")
-        print(
-            f"Updated {len(embeddings)} rows with embeddings for column useembed_{column}"
+    async def write() -> int:
+        updated = 0
+        finished_workers = 0
+        while finished_workers < embed_workers:
+            item = await embedded.get()
+            if item is None:
+                finished_workers += 1
+                continue
+
+            started = time.perf_counter()
+            updated += await run_on_connection(write_batch, *item)
+            write_stats.record(len(item[0]), started)
+            print(f"{table_name}.{column}: {updated} rows embedded")
+
+        return updated
+
+    tasks = [
+        asyncio.create_task(fetch()),
+        *[asyncio.create_task(embed()) for _ in range(embed_workers)],
+        asyncio.create_task(write()),
+    ]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # The connections are closed once no stage is using them any more
+        await asyncio.gather(*tasks, return_exceptions=True)
+        read_conn.close()
+        write_conn.close()
+
+    return results[-1], [fetch_stats, embed_stats, write_stats]
+
+
+def has_description(cursor: cursor, table_name: str) -> bool:
+    cursor.execute("SELECT 1 FROM description_table WHERE t_name = %s;", (table_name,))
+    return cursor.fetchone() is not None
+
+
+def replace_description(cursor: cursor, table_name: str, description: str) -> None:
+    cursor.execute("DELETE FROM description_table WHERE t_name = %s;", (table_name,))
+    cursor.execute(
+        "INSERT INTO description_table (t_name, description) VALUES (%s, %s);",
+        (table_name, description),
+    )
+
+
+# The chosen text columns will be embedding into vectors and will be inserted into a new corresponding column
+# The existing columns will be renamed to usevec_[col] and the new column will be useembed_[col]
+# Re-running only embeds rows that are new or whose text changed, unless full_refresh is set
+async def embedd_text_columns_and_add_description(
+    table_name: str,
+    columns: List[str],
+    embedder: BaseEmbedder,
+    full_refresh: bool = False,
+) -> None:
+    conn = await connect()
+    try:
+        cursor = conn.cursor()
+
+        has_new_columns = False
+
+        for column in columns:
+            try:
+                is_new = await asyncio.to_thread(
+                    prepare_embedding_columns,
+                    cursor,
+                    table_name,
+                    column,
+                    embedder.get_dim(),
+                )
+                if full_refresh:
+                    await asyncio.to_thread(
+                        cursor.execute,
+                        f"UPDATE {table_name} SET usehash_{column} = NULL;",
+                    )
+                await asyncio.to_thread(conn.commit)
+
+                updated, stage_stats = await embed_column(table_name, column, embedder)
+            except Exception as e:
+                await asyncio.to_thread(conn.rollback)
+                print(f"Failed to embed column {column}: {e}")
+                continue
+
+            has_new_columns = has_new_columns or is_new
+
+            print()
+            print(f"For column: {table_name}.{column}")
+            if is_new:
+                print(f"Changed column name to usevec_{column}")
+            print(
+                f"Updated {updated} rows with embeddings for column useembed_{column}"
+            )
+            for stats in stage_stats:
+                print(f"  {stats}")
+            print(f"Embedding cache: {embedder.stats()}")
+            print()
+
+        # The description only has to be (re)generated when the table changed shape
+        if has_new_columns or not await asyncio.to_thread(
+            has_description, cursor, table_name
+        ):
+            table_sample = await asyncio.to_thread(get_sample, cursor, table_name)
+            table_description = await get_table_description(table_name, table_sample)
+
+            await asyncio.to_thread(
+                replace_description, cursor, table_name, table_description
+            )
+
+        # Running servers drop their cached schema catalog once this transaction commits
+        await asyncio.to_thread(
+            cursor.execute, f"NOTIFY {settings.SCHEMA_CATALOG_CHANNEL};"
         )
-        print()
 
-    table_sample = get_sample(cursor, table_name)
-    table_description = get_table_description(table_name, table_sample)
+        await asyncio.to_thread(conn.commit)
+
+        # Without indexes every semantic or keyword query is a sequential scan
+        await asyncio.to_thread(ensure_vector_indexes, conn, [table_name])
+    finally:
+        conn.close()
+
+
+# Text a table is routed by: its name, description and the columns the LLM sees
+def get_routing_text(cursor: cursor, table_name: str, description: str) -> str:
+    columns = [
+        row[0].removeprefix("usevec_") for row in get_schema_rows(cursor, table_name)
+    ]
+    return f"{table_name}: {description}\nColumns: {', '.join(columns)}"
+
+
+# Embeds the descriptions into description_table.useembed_description, used to route
+# questions to tables (agents/table_router.py)
+# Regenerated descriptions are new rows, so only rows without a vector are embedded
+async def embed_table_descriptions(embedder: BaseEmbedder) -> int:
+    conn = await connect()
+    cursor = conn.cursor()
 
     cursor.execute(
         f"""
-        INSERT INTO description_table (t_name, description) 
-        VALUES ('{table_name}', '{table_description}');
+        ALTER TABLE description_table
+            ADD COLUMN IF NOT EXISTS useembed_description vector({embedder.get_dim()});
     """
     )
+    cursor.execute(
+        """
+        SELECT id, t_name, description FROM description_table
+        WHERE useembed_description IS NULL;
+    """
+    )
+    rows = cursor.fetchall()
+
+    updated = 0
+    if rows:
+        texts = [get_routing_text(cursor, row[1], row[2]) for row in rows]
+        embeddings = await embedder.aembed_chunks(texts)
+        updated = copy_embeddings(
+            cursor,
+            "description_table",
+            "description",
+            [row[0] for row in rows],
+            embeddings,
+        )
+        cursor.execute(f"NOTIFY {settings.SCHEMA_CATALOG_CHANNEL};")
 
     conn.commit()
+    await asyncio.to_thread(ensure_vector_indexes, conn, ["description_table"])
+    conn.close()
+
+    print(f"Embedded {updated} table descriptions")
+    return updated
+
 
+# Text columns that can be embedded, already embedded ones are listed by their original name
+def get_embeddable_columns(cursor: cursor, table_name: str) -> List[str]:
+    return [
+        column.removeprefix("usevec_")
+        for column in get_columns(cursor, table_name)
+        if not column.startswith("usehash_")
+    ]
 
-# Iterates through all the tables and embeds the necessary text columns
-def process_db() -> None:
+
+# Asks on stdin which columns of every table should be embedded
+def ask_columns_to_embed() -> Dict[str, List[str]]:
     c = PGConnection(settings.POSTGRES_DSN.unicode_string())
     conn = c.get_conn()
     cursor = conn.cursor()
 
-    tables = get_tables(cursor)
-
-    for table in tables:
-        columns = get_columns(cursor, table)
+    tables_to_embed = {}
+    for table in get_tables(cursor):
+        columns = get_embeddable_columns(cursor, table)
         print("Table name: ", table)
         print("Text columns: ", ", ".join(columns))
 
         print("Enter the columns to embed: (Space separated)")
-        columns_to_embed = input().split(", ")
-
-        embedd_text_columns_and_add_description(conn, cursor, table, columns_to_embed)
-        print("----DONE----")
+        tables_to_embed[table] = input().split(", ")
         print()
 
+    conn.close()
+    return tables_to_embed
+
+
+# Embeds the chosen text columns of every table
+# Several tables are processed at once, their descriptions are generated in parallel
+async def process_db(
+    tables_to_embed: Dict[str, List[str]],
+    full_refresh: bool = False,
+    table_concurrency: int = settings.PROCESS_DB_TABLE_CONCURRENCY,
+) -> None:
+    embedder = CachedEmbedder(AzureOpenAIEmbedder())
+    semaphore = asyncio.Semaphore(table_concurrency)
+
+    # A failed table is reported and doesn't stop the others, they resume where they
+    # stopped on the next run
+    async def process_table(table_name: str, columns: List[str]) -> None:
+        async with semaphore:
+            try:
+                await embedd_text_columns_and_add_description(
+                    table_name, columns, embedder, full_refresh=full_refresh
+                )
+            except Exception as e:
+                print(f"----FAILED {table_name}: {e}----")
+                print()
+                return
+
+            print(f"----DONE {table_name}----")
+            print()
+
+    await asyncio.gather(
+        *[
+            process_table(table_name, columns)
+            for table_name, columns in tables_to_embed.items()
+            if columns
+        ]
+    )
+
+    await embed_table_descriptions(embedder)
+
+
+# --table value, TABLE=COL1,COL2
+def parse_table_arg(value: str) -> Tuple[str, List[str]]:
+    table_name, sep, columns = value.partition("=")
+    columns = [c.strip() for c in columns.split(",") if c.strip()]
+    if not sep or not table_name.strip() or not columns:
+        raise argparse.ArgumentTypeError(f"expected TABLE=COL1,COL2, got {value!r}")
+    return table_name.strip(), columns
+
+
+# Tables come from --config (JSON: {"tables": {"goods": ["description"]}}) and/or --table,
+# the columns are asked on stdin when neither is given
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Embed the text columns of the tables")
+    parser.add_argument(
+        "--config",
+        help="JSON file with the tables and columns to embed and optional settings",
+    )
+    parser.add_argument(
+        "--table",
+        action="append",
+        default=[],
+        type=parse_table_arg,
+        metavar="TABLE=COL1,COL2",
+        help="Table and columns to embed, can be repeated",
+    )
+    parser.add_argument(
+        "--table-concurrency",
+        type=int,
+        help="Number of tables processed at the same time",
+    )
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="Re-embed every row instead of only the new and changed ones",
+    )
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
-    process_db()
+    args = parse_args()
+
+    config: Dict[str, Any] = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    tables_to_embed: Dict[str, List[str]] = dict(config.get("tables", {}))
+    for table_name, columns in args.table:
+        tables_to_embed[table_name] = columns
+
+    if not tables_to_embed:
+        tables_to_embed = ask_columns_to_embed()
+
+    asyncio.run(
+        process_db(
+            tables_to_embed,
+            full_refresh=args.full_refresh or config.get("full_refresh", False),
+            table_concurrency=args.table_concurrency
+            or config.get("table_concurrency", settings.PROCESS_DB_TABLE_CONCURRENCY),
+        )
+    )
@@ -1,4 +1,6 @@
-from typing import List
+import io
+import itertools
+from typing import Any, Iterable, Iterator, List, Optional, Sequence
 
 from langchain_core.prompts import PromptTemplate
 from psycopg2.extensions import cursor
@@ -29,28 +31,69 @@ def get_columns(cursor: cursor, table_name: str) -> List[str]:
     ]
 
 
-# Generates a sample with schema information and k rows from the table
-# this helps the LLM to understand what and how the table store something
-def get_sample(cursor: cursor, table_name: str, limit: int = 5) -> str:
-    # Get schema info and filter out columns starting with 'useembed_'
+# Gets the names of all the columns of a table
+def get_column_names(cursor: cursor, table_name: str) -> List[str]:
     cursor.execute(
         """
-        SELECT 
-            column_name, 
-            data_type, 
-            is_nullable, 
-            column_default
-        FROM 
-            information_schema.columns
-        WHERE 
-            table_schema = 'public' AND table_name = %s
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s
         ORDER BY ordinal_position;
         """,
         (table_name,),
     )
-    schema_rows = cursor.fetchall()
-    schema_rows = [row for row in schema_rows if not row[0].startswith("useembed_")]
+    return [row[0] for row in cursor.fetchall()]
+
+
+# Columns managed by process_db that the LLM never needs to see
+# useembed_ holds the vectors, usehash_ the hash of the text they were built from and
+# usets_ the generated tsvector of the text
+HIDDEN_PREFIXES = ("useembed_", "usehash_", "usets_")
+
+
+SCHEMA_ROWS_QUERY = """
+    SELECT 
+        column_name, 
+        data_type, 
+        is_nullable, 
+        column_default
+    FROM 
+        information_schema.columns
+    WHERE 
+        table_schema = 'public' AND table_name = %s
+    ORDER BY ordinal_position;
+"""
+
+
+# vector and hash columns are left out, the LLM can't read them
+def filter_hidden_columns(schema_rows: List[tuple]) -> List[tuple]:
+    return [row for row in schema_rows if not row[0].startswith(HIDDEN_PREFIXES)]
+
+
+# Gets the schema rows (name, type, nullable, default) of a table
+def get_schema_rows(cursor: cursor, table_name: str) -> List[tuple]:
+    cursor.execute(SCHEMA_ROWS_QUERY, (table_name,))
+    return filter_hidden_columns(cursor.fetchall())
+
+
+# Query of the first k rows of the given columns, k is the only parameter
+def sample_rows_query(table_name: str, column_names: List[str]) -> str:
+    col_list_sql = ", ".join(f'"{col}"' for col in column_names)
+    return f'SELECT {col_list_sql} FROM "{table_name}" LIMIT %s;'
 
+
+# Gets the first k rows of the given columns
+def get_sample_rows(
+    cursor: cursor, table_name: str, column_names: List[str], limit: int = 5
+) -> List[tuple]:
+    cursor.execute(sample_rows_query(table_name, column_names), (limit,))
+    return cursor.fetchall()
+
+
+# Renders the schema and sample rows of a table as markdown
+def render_sample_markdown(
+    table_name: str, schema_rows: List[tuple], sample_rows: List[tuple], limit: int = 5
+) -> str:
     # Build markdown schema
     schema_md = f"## Schema of table `{table_name}`\n\n"
     schema_md += "| Column Name | Data Type | Is Nullable | Default |\n"
@@ -60,12 +103,7 @@ def get_sample(cursor: cursor, table_name: str, limit: int = 5) -> str:
             *[c if c is not None else "" for c in col]
         )
 
-    # Get sample data and filter out vector columns
-    all_column_names = [row[0] for row in schema_rows]  # only non-vector columns
-    col_list_sql = ", ".join(f'"{col}"' for col in all_column_names)
-
-    cursor.execute(f'SELECT {col_list_sql} FROM "{table_name}" LIMIT %s;', (limit,))
-    sample_rows = cursor.fetchall()
+    all_column_names = [row[0] for row in schema_rows]
 
     data_md = f"\n## Markdown version of first {limit} rows\n\n"
     data_md += "| " + " | ".join(all_column_names) + " |\n"
@@ -78,6 +116,114 @@ def get_sample(cursor: cursor, table_name: str, limit: int = 5) -> str:
     return schema_md + data_md
 
 
+# Generates a sample with schema information and k rows from the table
+# this helps the LLM to understand what and how the table store something
+def get_sample(cursor: cursor, table_name: str, limit: int = 5) -> str:
+    schema_rows = get_schema_rows(cursor, table_name)
+
+    # only non-vector columns
+    all_column_names = [row[0] for row in schema_rows]
+    sample_rows = get_sample_rows(cursor, table_name, all_column_names, limit)
+
+    return render_sample_markdown(table_name, schema_rows, sample_rows, limit)
+
+
+# Read-only file object over an iterator of strings, so COPY can stream rows
+# without building the whole payload in memory
+class IteratorFile(io.TextIOBase):
+    def __init__(self, lines: Iterator[str]) -> None:
+        self._lines = lines
+        self._buffer = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+
+        if size < 0:
+            chunk, self._buffer = self._buffer, ""
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+
+# Escapes a value for the COPY text format
+def copy_escape(value: Any) -> str:
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def vector_literal(embedding: Sequence[float]) -> str:
+    return "[" + ",".join(str(float(value)) for value in embedding) + "]"
+
+
+# Writes embeddings into useembed_[column] with one COPY and one set-based UPDATE
+# instead of one UPDATE round-trip per row. Returns the number of updated rows
+# When content hashes are given, usehash_[column] records which text each vector was built from
+def copy_embeddings(
+    cursor: cursor,
+    table_name: str,
+    column: str,
+    ids: Iterable[Any],
+    embeddings: Iterable[Sequence[float]],
+    hashes: Optional[Iterable[str]] = None,
+) -> int:
+    # The staging id must have the same type as the table id, so the join can use its index
+    cursor.execute(
+        """
+        SELECT format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attname = 'id';
+        """,
+        (table_name,),
+    )
+    id_type = cursor.fetchone()[0]
+
+    cursor.execute("DROP TABLE IF EXISTS pg_temp.embedding_staging;")
+    cursor.execute(
+        f"CREATE TEMP TABLE embedding_staging (id {id_type}, embedding vector, content_hash TEXT) ON COMMIT DROP;"
+    )
+
+    track_hashes = hashes is not None
+    if not track_hashes:
+        hashes = itertools.repeat(None)
+
+    lines = (
+        f"{copy_escape(row_id)}\t{vector_literal(embedding)}\t{copy_escape(content_hash)}\n"
+        for row_id, embedding, content_hash in zip(ids, embeddings, hashes)
+    )
+    cursor.copy_expert(
+        "COPY pg_temp.embedding_staging (id, embedding, content_hash) FROM STDIN;",
+        IteratorFile(lines),
+    )
+
+    set_hash = f", usehash_{column} = s.content_hash" if track_hashes else ""
+    cursor.execute(
+        f"""
+        UPDATE {table_name} AS t
+        SET useembed_{column} = s.embedding{set_hash}
+        FROM pg_temp.embedding_staging AS s
+        WHERE t.id = s.id;
+    """
+    )
+    return cursor.rowcount
+
+
 GET_TABLE_DESCRIPTION = """
 # SYSTEM INSTRUCTIONS
 You are the first state of a text-to-SQL system. You have to generate a description for the table.
@@ -1,4 +1,8 @@
-from typing import List
+import asyncio
+from typing import Iterator, List, Optional
+
+from config import settings
+from embedder.rate_limit import get_rate_limiters, retry_on_rate_limit
 
 
 def batch_list(input_list, batch_size=2048):
@@ -7,8 +11,51 @@ def batch_list(input_list, batch_size=2048):
 
 
 class BaseEmbedder:
+    model: str
+    batch_size: int = 2048
+
     def embed_chunks(self, chunks: List[str]) -> List[List[float]]:
         pass
 
     def embed_texts(self, texts: List[str]) -> List[List[float]]:
         pass
+
+    # Providers with an async client override this, the rest run in a worker thread
+    async def aembed_texts(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_texts, texts)
+
+    # Rough estimate used by the tokens-per-minute limiter
+    def count_tokens(self, texts: List[str]) -> int:
+        return sum(len(str(text)) // 4 + 1 for text in texts)
+
+    # Same cleanup embed_chunks applies before batching
+    def prepare_chunks(self, chunks: List[str]) -> List[str]:
+        return chunks
+
+    # Splits the chunks into the inputs of one embedding request each
+    def make_batches(self, chunks: List[str]) -> Iterator[List[str]]:
+        return batch_list(chunks, batch_size=self.batch_size)
+
+    # Concurrent version of embed_chunks
+    # Up to `max_concurrency` batches are in flight, throttled by the model's request and
+    # token limiters and retried on 429s. The output keeps the order of the input
+    async def aembed_chunks(
+        self,
+        chunks: List[str],
+        max_concurrency: Optional[int] = None,
+    ) -> List[List[float]]:
+        semaphore = asyncio.Semaphore(
+            max_concurrency or settings.EMBEDDING_MAX_CONCURRENCY
+        )
+        request_limiter, token_limiter = get_rate_limiters(self.model)
+
+        async def embed_batch(batch: List[str]) -> List[List[float]]:
+            async with semaphore:
+                await request_limiter.acquire(1)
+                await token_limiter.acquire(self.count_tokens(batch))
+                return await retry_on_rate_limit(lambda: self.aembed_texts(batch))
+
+        batches = self.make_batches(self.prepare_chunks(chunks))
+        results = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+
+        return [embedding for result in results for embedding in result]
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from diskcache import Cache
+
+from config import settings
+from embedder.base import BaseEmbedder
+
+
+# Wraps any embedder with a persistent, content-addressed cache
+# Vectors are keyed by the model (and task mode, if any) plus a hash of the text
+# and kept on disk, so re-running the ingestion or repeating a question doesn't hit the API
+class CachedEmbedder(BaseEmbedder):
+    def __init__(
+        self,
+        embedder: BaseEmbedder,
+        directory: str = settings.EMBEDDING_CACHE_DIR,
+        size_limit: int = settings.EMBEDDING_CACHE_SIZE_LIMIT,
+    ) -> None:
+        self.embedder = embedder
+        self.model = embedder.model
+        self.namespace = ":".join(
+            str(part) for part in (self.model, getattr(embedder, "mode", "")) if part
+        )
+
+        # diskcache evicts the least recently read vectors once size_limit bytes are used
+        self.cache = Cache(
+            directory,
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+        )
+
+        self.hits = 0
+        self.misses = 0
+
+    # repr() keeps texts of other types apart from their string form, e.g. None and "None"
+    def _key(self, text: Any) -> str:
+        digest = hashlib.sha256(repr(text).encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{digest}"
+
+    # Returns the cached vectors (None where missing) and the texts that still need embedding
+    def _lookup(
+        self, texts: List[Any]
+    ) -> Tuple[List[str], List[Optional[List[float]]], Dict[str, Any]]:
+        keys = [self._key(text) for text in texts]
+        embeddings = [self.cache.get(key) for key in keys]
+
+        # Texts repeated within the input are only sent once
+        missing: Dict[str, Any] = {}
+        for key, text, embedding in zip(keys, texts, embeddings):
+            if embedding is None:
+                missing.setdefault(key, text)
+
+        self.misses += len(missing)
+        self.hits += len(texts) - sum(embedding is None for embedding in embeddings)
+
+        return keys, embeddings, missing
+
+    def _store(
+        self,
+        keys: List[str],
+        embeddings: List[Optional[List[float]]],
+        missing: Dict[str, Any],
+        new_embeddings: List[List[float]],
+    ) -> List[List[float]]:
+        by_key = dict(zip(missing.keys(), new_embeddings))
+        for key, embedding in by_key.items():
+            self.cache.set(key, embedding)
+
+        return [
+            embedding if embedding is not None else by_key[key]
+            for key, embedding in zip(keys, embeddings)
+        ]
+
+    def _embed(
+        self, texts: List[Any], embed_fn: Callable[[List[Any]], List[List[float]]]
+    ) -> List[List[float]]:
+        keys, embeddings, missing = self._lookup(texts)
+        if not missing:
+            return embeddings
+
+        new_embeddings = embed_fn(list(missing.values()))
+        return self._store(keys, embeddings, missing, new_embeddings)
+
+    async def _aembed(
+        self,
+        texts: List[Any],
+        embed_fn: Callable[[List[Any]], Awaitable[List[List[float]]]],
+    ) -> List[List[float]]:
+        # diskcache reads and writes SQLite files, kept off the event loop
+        keys, embeddings, missing = await asyncio.to_thread(self._lookup, texts)
+        if not missing:
+            return embeddings
+
+        new_embeddings = await embed_fn(list(missing.values()))
+        return await asyncio.to_thread(
+            self._store, keys, embeddings, missing, new_embeddings
+        )
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, self.embedder.embed_texts)
+
+    def embed_chunks(self, chunks: List[str]) -> List[List[float]]:
+        return self._embed(chunks, self.embedder.embed_chunks)
+
+    async def aembed_texts(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed(texts, self.embedder.aembed_texts)
+
+    async def aembed_chunks(
+        self, chunks: List[str], max_concurrency: Optional[int] = None
+    ) -> List[List[float]]:
+        return await self._aembed(
+            chunks,
+            lambda texts: self.embedder.aembed_chunks(texts, max_concurrency),
+        )
+
+    def get_dim(self):
+        return self.embedder.get_dim()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self.cache),
+            "size_bytes": self.cache.volume(),
+        }
@@ -7,6 +7,8 @@ from embedder.base import BaseEmbedder, batch_list
 
 
 class GeminiEmbedder(BaseEmbedder):
+    batch_size = 100
+
     def __init__(
         self,
         model: str,
@@ -33,10 +35,21 @@ class GeminiEmbedder(BaseEmbedder):
 
         return embeddings
 
+    async def aembed_texts(self, texts: List[str]) -> List[List[float]]:
+        texts = [str(i) for i in texts]
+
+        embedding_response = await self.client.aio.models.embed_content(
+            contents=texts,
+            model=self.model,
+            config=types.EmbedContentConfig(task_type=self.mode),
+        )
+
+        return [embedding.values for embedding in embedding_response.embeddings]
+
     def embed_chunks(self, chunks: List[str]) -> List[List[float]]:
         embeddings = []
 
-        input_batches = list(batch_list(chunks, batch_size=100))
+        input_batches = list(batch_list(chunks, batch_size=self.batch_size))
 
         for batch in input_batches:
             embeddings.extend(self.embed_texts(batch))
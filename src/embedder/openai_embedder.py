@@ -1,15 +1,46 @@
-from typing import List
+from typing import Iterator, List
 
-from openai import AzureOpenAI, OpenAI
+import tiktoken
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI
 
 from config import settings
-from embedder.base import BaseEmbedder, batch_list
+from embedder.base import BaseEmbedder
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# Batches of at most `batch_size` texts and `max_tokens` tokens, an embeddings request is
+# limited in both
+def batch_by_tokens(
+    texts: List[str], encoding: tiktoken.Encoding, batch_size: int, max_tokens: int
+) -> Iterator[List[str]]:
+    batch: List[str] = []
+    batch_tokens = 0
+    for text, tokens in zip(texts, encoding.encode_batch(texts, disallowed_special=())):
+        if batch and (
+            len(batch) >= batch_size or batch_tokens + len(tokens) > max_tokens
+        ):
+            yield batch
+            batch, batch_tokens = [], 0
+
+        batch.append(text)
+        batch_tokens += len(tokens)
+
+    if batch:
+        yield batch
 
 
 class OpenAIEmbedder(BaseEmbedder):
     def __init__(self, model: str) -> None:
         self.client = OpenAI()
+        self.aclient = AsyncOpenAI()
         self.model = model
+        self.encoding = get_encoding(model)
 
     def embed_texts(self, texts: List[str]) -> List[List[float]]:
         embedding_response = self.client.embeddings.create(
@@ -22,12 +53,33 @@ class OpenAIEmbedder(BaseEmbedder):
 
         return embeddings
 
+    async def aembed_texts(self, texts: List[str]) -> List[List[float]]:
+        embedding_response = await self.aclient.embeddings.create(
+            input=texts, model=self.model
+        )
+
+        return [embedding.embedding for embedding in embedding_response.data]
+
+    def count_tokens(self, texts: List[str]) -> int:
+        return sum(
+            len(tokens)
+            for tokens in self.encoding.encode_batch(texts, disallowed_special=())
+        )
+
+    def prepare_chunks(self, chunks: List[str]) -> List[str]:
+        return [i if i else "N/A" for i in chunks]
+
+    def make_batches(self, chunks: List[str]) -> Iterator[List[str]]:
+        return batch_by_tokens(
+            chunks, self.encoding, self.batch_size, settings.EMBEDDING_MAX_BATCH_TOKENS
+        )
+
     def embed_chunks(self, chunks: List[str]) -> List[List[float]]:
         embeddings = []
 
-        chunks = [i if i else "N/A" for i in chunks]
+        chunks = self.prepare_chunks(chunks)
 
-        input_batches = list(batch_list(chunks))
+        input_batches = list(self.make_batches(chunks))
 
         for batch in input_batches:
             embeddings.extend(self.embed_texts(batch))
@@ -45,7 +97,13 @@ class AzureOpenAIEmbedder(BaseEmbedder):
             azure_endpoint=settings.AZURE_GPT_ENDPOINT,
             api_key=settings.AZURE_GPT_KEY,
         )
+        self.aclient = AsyncAzureOpenAI(
+            api_version="2025-01-01-preview",
+            azure_endpoint=settings.AZURE_GPT_ENDPOINT,
+            api_key=settings.AZURE_GPT_KEY,
+        )
         self.model = model
+        self.encoding = get_encoding(model)
 
     def embed_texts(self, texts: List[str]) -> List[List[float]]:
         embedding_response = self.client.embeddings.create(
@@ -58,12 +116,33 @@ class AzureOpenAIEmbedder(BaseEmbedder):
 
         return embeddings
 
+    async def aembed_texts(self, texts: List[str]) -> List[List[float]]:
+        embedding_response = await self.aclient.embeddings.create(
+            input=texts, model=self.model
+        )
+
+        return [embedding.embedding for embedding in embedding_response.data]
+
+    def count_tokens(self, texts: List[str]) -> int:
+        return sum(
+            len(tokens)
+            for tokens in self.encoding.encode_batch(texts, disallowed_special=())
+        )
+
+    def prepare_chunks(self, chunks: List[str]) -> List[str]:
+        return [i if i else "N/A" for i in chunks]
+
+    def make_batches(self, chunks: List[str]) -> Iterator[List[str]]:
+        return batch_by_tokens(
+            chunks, self.encoding, self.batch_size, settings.EMBEDDING_MAX_BATCH_TOKENS
+        )
+
     def embed_chunks(self, chunks: List[str]) -> List[List[float]]:
         embeddings = []
 
-        chunks = [i if i else "N/A" for i in chunks]
+        chunks = self.prepare_chunks(chunks)
 
-        input_batches = list(batch_list(chunks))
+        input_batches = list(self.make_batches(chunks))
 
         for batch in input_batches:
             embeddings.extend(self.embed_texts(batch))
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import random
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from config import settings
+
+
+# Token bucket that refills continuously up to `per_minute` units
+# A limit of None never waits
+class AsyncRateLimiter:
+    def __init__(self, per_minute: Optional[int]) -> None:
+        self.per_minute = per_minute
+        self._available = float(per_minute or 0)
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        rate = self.per_minute / 60
+        self._available = min(
+            self.per_minute, self._available + (now - self._updated_at) * rate
+        )
+        self._updated_at = now
+
+    async def acquire(self, amount: int = 1) -> None:
+        if not self.per_minute:
+            return
+
+        # A single request bigger than the budget waits for a full bucket
+        amount = min(amount, self.per_minute)
+        while True:
+            self._refill()
+            if self._available >= amount:
+                self._available -= amount
+                return
+            await asyncio.sleep((amount - self._available) / (self.per_minute / 60))
+
+
+# Token bucket kept in a SQLite file (WAL), shared by every process of the host: the
+# server workers and the ingestion scripts stay within one provider budget together
+# Each acquire takes the tokens in a short write transaction run in the default executor
+class SQLiteRateLimiter(AsyncRateLimiter):
+    def __init__(
+        self,
+        per_minute: Optional[int],
+        key: str,
+        path: str = settings.RATE_LIMITER_PATH,
+    ) -> None:
+        super().__init__(per_minute)
+        self.key = key
+        self.path = path
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY,
+                    available REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._initialized = True
+        return conn
+
+    # Takes `amount` from the bucket when it has them, otherwise returns how long to wait
+    def _take(self, amount: int) -> float:
+        rate = self.per_minute / 60
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT available, updated_at FROM rate_limits WHERE key = ?",
+                (self.key,),
+            ).fetchone()
+
+            now = time.time()
+            available = float(self.per_minute)
+            if row is not None:
+                available = min(available, row[0] + (now - row[1]) * rate)
+
+            wait = 0.0
+            if available >= amount:
+                available -= amount
+            else:
+                wait = (amount - available) / rate
+
+            conn.execute(
+                """
+                INSERT INTO rate_limits (key, available, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE
+                SET available = excluded.available, updated_at = excluded.updated_at
+                """,
+                (self.key, available, now),
+            )
+            conn.execute("COMMIT")
+            return wait
+        finally:
+            conn.close()
+
+    async def acquire(self, amount: int = 1) -> None:
+        if not self.per_minute:
+            return
+
+        amount = min(amount, self.per_minute)
+        while (wait := await asyncio.to_thread(self._take, amount)) > 0:
+            await asyncio.sleep(wait)
+
+
+# Provider limits are per account and model, so the limiters are shared by every embedder instance
+_limiters: Dict[str, Tuple[AsyncRateLimiter, AsyncRateLimiter]] = {}
+
+
+def get_rate_limiters(model: str) -> Tuple[AsyncRateLimiter, AsyncRateLimiter]:
+    if model not in _limiters:
+        if settings.RATE_LIMITER_BACKEND == "sqlite":
+            _limiters[model] = (
+                SQLiteRateLimiter(
+                    settings.EMBEDDING_REQUESTS_PER_MINUTE, f"{model}:requests"
+                ),
+                SQLiteRateLimiter(
+                    settings.EMBEDDING_TOKENS_PER_MINUTE, f"{model}:tokens"
+                ),
+            )
+        else:
+            _limiters[model] = (
+                AsyncRateLimiter(settings.EMBEDDING_REQUESTS_PER_MINUTE),
+                AsyncRateLimiter(settings.EMBEDDING_TOKENS_PER_MINUTE),
+            )
+    return _limiters[model]
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    # openai.RateLimitError has status_code, google.genai.errors.APIError has code
+    return getattr(e, "status_code", None) == 429 or getattr(e, "code", None) == 429
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Retries the call with exponential backoff and jitter when the provider answers 429
+async def retry_on_rate_limit(
+    fn: Callable[[], Awaitable[Any]],
+    max_retries: int = settings.EMBEDDING_MAX_RETRIES,
+    base_delay: float = 1.0,
+) -> Any:
+    for attempt in range(max_retries + 1):
+        try:
+            return await fn()
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+
+            delay = _retry_after(e) or base_delay * 2**attempt
+            await asyncio.sleep(delay * (1 + random.random() / 2))
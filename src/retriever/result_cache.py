@@ -0,0 +1,222 @@
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import settings
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    '(?:[^']|'')*'      # string literal
+    | "(?:[^"]|"")+"    # quoted identifier
+    | %\(\w+\)s         # bound parameter
+    | [a-z_][\w$]*      # keyword or identifier
+    | \S               # anything else, one character at a time
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+
+# Keywords that end the list of tables of a FROM clause
+END_OF_FROM = {
+    "where",
+    "group",
+    "having",
+    "window",
+    "order",
+    "limit",
+    "offset",
+    "fetch",
+    "for",
+    "union",
+    "intersect",
+    "except",
+    "returning",
+    "select",
+}
+
+
+# Collapses the whitespace and trailing semicolons LLM-written statements vary in
+def normalize_sql(query: str) -> str:
+    return " ".join(query.split()).rstrip("; ")
+
+
+def is_identifier(token: str) -> bool:
+    return token[0] == '"' or token[0].isalpha() or token[0] == "_"
+
+
+def unquote(token: str) -> str:
+    if token[0] == '"':
+        return token[1:-1].replace('""', '"').lower()
+    return token.lower()
+
+
+# Tables a statement reads from, used to invalidate its cached result
+# Follows comma separated FROM lists, joins, subqueries, schema qualified and quoted
+# names, and returns None when a FROM item can't be read, so the result isn't cached
+def extract_tables(query: str) -> Optional[Set[str]]:
+    tokens = TOKEN_PATTERN.findall(query)
+    tables: Set[str] = set()
+    # State of the FROM list at every parenthesis depth: None outside of one,
+    # "item" when a table is expected and "after" once it was read
+    states: List[Optional[str]] = [None]
+
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        word = token.lower()
+        i += 1
+
+        if token == "(":
+            # A subquery or a parenthesized join is an item of the enclosing list
+            if states[-1] == "item":
+                states[-1] = "after"
+            states.append(None)
+            continue
+        if token == ")":
+            if len(states) > 1:
+                states.pop()
+            continue
+
+        if word in ("from", "join"):
+            states[-1] = "item"
+            continue
+
+        if states[-1] == "item":
+            if word in ("lateral", "only"):
+                continue
+            if not is_identifier(token):
+                return None
+
+            name = unquote(token)
+            while (
+                i + 1 < len(tokens)
+                and tokens[i] == "."
+                and is_identifier(tokens[i + 1])
+            ):
+                name = unquote(tokens[i + 1])
+                i += 2
+
+            # A set returning function, e.g. plainto_tsquery(...) q
+            if i >= len(tokens) or tokens[i] != "(":
+                tables.add(name)
+            states[-1] = "after"
+        elif states[-1] == "after":
+            if token == ",":
+                states[-1] = "item"
+            elif word in END_OF_FROM:
+                states[-1] = None
+
+    return tables
+
+
+# In-process cache of executed statements
+# Keyed by the normalized SQL and its bound parameters (the embedding by hash), entries
+# expire after `ttl` seconds and the least recently used ones are evicted above `max_bytes`
+# Results are dropped as soon as one of their tables changes, through a NOTIFY on
+# settings.RESULT_CACHE_CHANNEL (see db_scripts/table_notify.sql)
+class ResultCache:
+    def __init__(
+        self,
+        ttl: float = settings.RESULT_CACHE_TTL,
+        max_bytes: int = settings.RESULT_CACHE_MAX_BYTES,
+    ) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # Bumped by every invalidation, results loaded before one are not stored
+        self.generation = 0
+
+        # key -> (expires_at, tables, rows, size)
+        self._entries: OrderedDict[str, Tuple[float, Set[str], List[Dict], int]] = (
+            OrderedDict()
+        )
+        self._keys_by_table: Dict[str, Set[str]] = {}
+        self._bytes = 0
+
+        self._metrics = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def make_key(self, query: str, params: Dict) -> str:
+        key = {"sql": normalize_sql(query), **params}
+        if key.get("embedding"):
+            key["embedding"] = hashlib.sha256(key["embedding"].encode()).hexdigest()
+        return hashlib.sha256(
+            json.dumps(key, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self._metrics["misses"] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._metrics["hits"] += 1
+        # Callers may modify the rows they get, the cached ones stay untouched
+        return [dict(row) for row in entry[2]]
+
+    def put(self, key: str, query: str, rows: List[Dict], generation: int) -> None:
+        tables = extract_tables(query)
+        # Without known tables the entry could never be invalidated
+        if generation != self.generation or not tables:
+            return
+
+        size = len(json.dumps(rows, default=str))
+        if size > self.max_bytes:
+            return
+
+        self._remove(key)
+        rows = [dict(row) for row in rows]
+        self._entries[key] = (time.monotonic() + self.ttl, tables, rows, size)
+        self._bytes += size
+        for table in tables:
+            self._keys_by_table.setdefault(table, set()).add(key)
+
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._metrics["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        self._bytes -= entry[3]
+        for table in entry[1]:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
+
+    def invalidate(self, table_name: str) -> None:
+        self.generation += 1
+        self._metrics["invalidations"] += 1
+        for key in list(self._keys_by_table.get(table_name.lower(), ())):
+            self._remove(key)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._metrics["invalidations"] += 1
+        self._entries.clear()
+        self._keys_by_table.clear()
+        self._bytes = 0
+
+    # Listener callback for the table channel, an empty payload (the listener reconnected
+    # and may have missed notifications) drops everything
+    def on_notify(self, payload: str) -> None:
+        if payload:
+            self.invalidate(payload)
+        else:
+            self.clear()
+
+    def stats(self) -> Dict:
+        lookups = self._metrics["hits"] + self._metrics["misses"]
+        return {
+            **self._metrics,
+            "hit_rate": self._metrics["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "size_bytes": self._bytes,
+        }
@@ -1,10 +1,28 @@
 import json
+import re
+from collections import OrderedDict
 from decimal import Decimal
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
 
 from config import settings
 from database.connection import PGConnection
+from database.pool import PGPool, pg_pool
+from embedder.base import BaseEmbedder
+from embedder.cache import CachedEmbedder
 from embedder.openai_embedder import AzureOpenAIEmbedder
+from retriever.result_cache import ResultCache
+
+EMBEDDING_PLACEHOLDER = "%(embedding)s"
+
+# Statement asking for a keyword + semantic search instead of SQL written by the LLM:
+#     HYBRID_SEARCH table.column RETURNING key_column, other_column, ...
+# The first returned column is the key the two searches are fused on
+HYBRID_SEARCH_PATTERN = re.compile(
+    r"^\s*HYBRID_SEARCH\s+(\w+)\.(\w+)\s+RETURNING\s+(\w+(?:\s*,\s*\w+)*)\s*;?\s*$",
+    re.IGNORECASE,
+)
 
 
 def decimal_serializer(obj):
@@ -13,43 +31,243 @@ def decimal_serializer(obj):
     raise TypeError(f"Type {type(obj)} not serializable")
 
 
+def needs_embedding(query: str) -> bool:
+    return EMBEDDING_PLACEHOLDER in query or is_hybrid_search(query)
+
+
+def is_hybrid_search(query: str) -> bool:
+    return HYBRID_SEARCH_PATTERN.match(query) is not None
+
+
+# Table, text column and returned columns of a HYBRID_SEARCH statement
+def parse_hybrid_search(query: str) -> Tuple[str, str, List[str]]:
+    match = HYBRID_SEARCH_PATTERN.match(query)
+    if match is None:
+        raise ValueError(f"Not a HYBRID_SEARCH statement: {query}")
+
+    table_name, column, columns = match.groups()
+    return (
+        table_name,
+        column.removeprefix("usevec_"),
+        [c.strip() for c in columns.split(",")],
+    )
+
+
+# Reciprocal rank fusion of a vector search on useembed_[column] and a keyword search on the
+# generated usets_[column], both answered by their indexes and fused in one round-trip
+# The rank is taken outside of the ORDER BY ... LIMIT so the planner can use the index scans
+def build_hybrid_query(
+    table_name: str,
+    column: str,
+    select_columns: List[str],
+    id_column: str = "id",
+) -> str:
+    return f"""
+        WITH semantic_search AS (
+            SELECT {id_column}, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+            FROM (
+                SELECT {id_column}, useembed_{column} <=> %(embedding)s::vector AS distance
+                FROM {table_name}
+                ORDER BY useembed_{column} <=> %(embedding)s::vector
+                LIMIT %(candidates)s
+            ) s
+        ),
+        keyword_search AS (
+            SELECT {id_column}, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+            FROM (
+                SELECT {id_column}, ts_rank_cd(usets_{column}, q) AS score
+                FROM {table_name}, plainto_tsquery('english', %(query)s) q
+                WHERE usets_{column} @@ q
+                ORDER BY score DESC
+                LIMIT %(candidates)s
+            ) s
+        ),
+        combined AS (
+            SELECT
+                COALESCE(semantic_search.{id_column}, keyword_search.{id_column}) AS {id_column},
+                COALESCE(1.0 / (%(rrf_k)s + semantic_search.rank), 0.0) +
+                COALESCE(1.0 / (%(rrf_k)s + keyword_search.rank), 0.0) AS score
+            FROM semantic_search
+            FULL OUTER JOIN keyword_search
+                ON semantic_search.{id_column} = keyword_search.{id_column}
+        )
+        SELECT {", ".join(f"t.{c}" for c in select_columns)}, c.score AS rrf_score
+        FROM combined c
+        JOIN {table_name} t ON t.{id_column} = c.{id_column}
+        ORDER BY c.score DESC
+        LIMIT %(k)s;
+    """
+
+
 # Retrieves data from the database, when the user queries something
 # invoked by the execute_query node
 class PGRetriever:
-    def __init__(self):
+    def __init__(
+        self,
+        pool: PGPool = pg_pool,
+        embedder: Optional[BaseEmbedder] = None,
+        max_cached_embeddings: int = 256,
+        result_cache: Optional[ResultCache] = None,
+    ):
         self.db_path = settings.POSTGRES_DSN.unicode_string()
+        self.pool = pool
         self.k = 10
+        # Disabled with RESULT_CACHE_ENABLED=false, every statement then hits Postgres
+        self.result_cache = result_cache or (
+            ResultCache() if settings.RESULT_CACHE_ENABLED else None
+        )
+
+        self._embedder = embedder
+        self.max_cached_embeddings = max_cached_embeddings
+        # user query -> serialized embedding, shared by every statement and retry of a question
+        self._embeddings: OrderedDict[str, str] = OrderedDict()
+
+    # The embedder is only created once a statement actually needs a vector
+    @property
+    def embedder(self) -> BaseEmbedder:
+        if self._embedder is None:
+            self._embedder = CachedEmbedder(AzureOpenAIEmbedder())
+        return self._embedder
+
+    def embedding_cache_stats(self) -> Dict:
+        if isinstance(self._embedder, CachedEmbedder):
+            return self._embedder.stats()
+        return {}
+
+    def _remember(self, user_query: str, embedding: str) -> str:
+        self._embeddings[user_query] = embedding
+        self._embeddings.move_to_end(user_query)
+        while len(self._embeddings) > self.max_cached_embeddings:
+            self._embeddings.popitem(last=False)
+        return embedding
+
+    def _cached_embedding(self, user_query: str) -> Optional[str]:
+        embedding = self._embeddings.get(user_query)
+        if embedding is not None:
+            self._embeddings.move_to_end(user_query)
+        return embedding
+
+    def embed_query(self, user_query: str) -> str:
+        embedding = self._cached_embedding(user_query)
+        if embedding is None:
+            vector = self.embedder.embed_texts([user_query])[0]
+            embedding = self._remember(user_query, json.dumps(vector))
+        return embedding
+
+    async def aembed_query(self, user_query: str) -> str:
+        embedding = self._cached_embedding(user_query)
+        if embedding is None:
+            vectors = await self.embedder.aembed_texts([user_query])
+            embedding = self._remember(user_query, json.dumps(vectors[0]))
+        return embedding
+
+    # Unit-length vector of the question, for in-process similarity lookups
+    async def aembed_query_array(self, user_query: str) -> np.ndarray:
+        vector = np.asarray(
+            json.loads(await self.aembed_query(user_query)), dtype=np.float32
+        )
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _build_params(
+        self, query: str, user_query: str, embedding: Optional[str]
+    ) -> Dict:
+        return {
+            "embedding": embedding,
+            "query": user_query if "query" in query else None,
+            "k": self.k if "k" in query else self.k,
+        }
 
     def get_relevant_documents(
         self,
         query: str,
         user_query: str,
     ) -> List[Dict]:
-        embedder = AzureOpenAIEmbedder()
-        user_query_embedding = embedder.embed_texts([user_query])[0]
+        embedding = self.embed_query(user_query) if needs_embedding(query) else None
+        params = self._build_params(query, user_query, embedding)
+
+        if self.result_cache is not None:
+            key = self.result_cache.make_key(query, params)
+            generation = self.result_cache.generation
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return cached
 
         # Connect to PostgreSQL
         c = PGConnection(self.db_path)
         conn = c.get_conn()
 
         try:
-            # Prepare SQL and parameters
-            params = {
-                "embedding": (
-                    json.dumps(user_query_embedding) if "embedding" in query else None
-                ),
-                "query": user_query if "query" in query else None,
-                "k": self.k if "k" in query else self.k,
-            }
-
             with conn.cursor() as cur:
                 cur.execute(query, params)
                 colnames = [desc[0] for desc in cur.description]
                 rows = cur.fetchall()
                 parsed_rows = [dict(zip(colnames, row)) for row in rows]
 
+            if self.result_cache is not None:
+                self.result_cache.put(key, query, parsed_rows, generation)
             return parsed_rows
         except Exception as e:
             raise e
         finally:
             conn.close()
+
+    # Same as get_relevant_documents, but runs on a pooled connection
+    async def aget_relevant_documents(
+        self,
+        query: str,
+        user_query: str,
+    ) -> List[Dict]:
+        embedding = (
+            await self.aembed_query(user_query) if needs_embedding(query) else None
+        )
+        params = self._build_params(query, user_query, embedding)
+
+        return await self._afetch(query, params)
+
+    # Keyword + semantic search over one embedded text column, fused by Postgres
+    # Returns the id and text column unless other columns are asked for, the first of
+    # which is the key the searches are fused on
+    async def ahybrid_search(
+        self,
+        table_name: str,
+        column: str,
+        user_query: str,
+        columns: Optional[List[str]] = None,
+        k: Optional[int] = None,
+    ) -> List[Dict]:
+        columns = columns or ["id", f"usevec_{column}"]
+        query = build_hybrid_query(table_name, column, columns, id_column=columns[0])
+        params = {
+            "embedding": await self.aembed_query(user_query),
+            "query": user_query,
+            "k": k or self.k,
+            "candidates": max(settings.HYBRID_CANDIDATES, k or self.k),
+            "rrf_k": settings.HYBRID_RRF_K,
+        }
+
+        return await self._afetch(query, params)
+
+    # Runs the statement on a pooled connection, unless its result is cached
+    async def _afetch(self, query: str, params: Dict) -> List[Dict]:
+        if self.result_cache is None:
+            async with self.pool.connection() as conn:
+                return await conn.fetch(query, params)
+
+        key = self.result_cache.make_key(query, params)
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
+
+        generation = self.result_cache.generation
+        async with self.pool.connection() as conn:
+            rows = await conn.fetch(query, params)
+
+        self.result_cache.put(key, query, rows, generation)
+        return rows
+
+    def result_cache_stats(self) -> Dict:
+        return self.result_cache.stats() if self.result_cache is not None else {}
+
+
+# Shared by the agents, so a question is embedded once across statements and correction retries
+pg_retriever = PGRetriever()
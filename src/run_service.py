@@ -1,6 +1,42 @@
+import argparse
+import os
+
 import uvicorn
 
-from server.service import app
+from config import settings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the SQL-RAG server")
+    parser.add_argument("--host", default=settings.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=settings.SERVER_PORT)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.SERVER_WORKERS,
+        help="Server processes behind the port, e.g. the number of cores",
+    )
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    args = parse_args()
+
+    if args.workers > 1:
+        # Workers only share what lives outside of their process
+        if settings.THREAD_STORE == "memory":
+            raise SystemExit("THREAD_STORE=memory can't be shared between workers")
+
+        # Read by the settings of every worker process, server.thread_store refuses a
+        # memory store there too
+        os.environ["SERVER_WORKERS"] = str(args.workers)
+        os.environ.setdefault("RATE_LIMITER_BACKEND", "sqlite")
+
+    # Every worker warms its pool and caches in the lifespan before it accepts requests
+    uvicorn.run(
+        "server.service:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_graceful_shutdown=settings.SERVER_SHUTDOWN_TIMEOUT,
+    )
@@ -0,0 +1,215 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+from config import settings
+
+
+# Raised instead of queueing a request the server can't take in time
+# The server answers it with `status_code` and a Retry-After of `retry_after` seconds
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, retry_after: int, reason: str) -> None:
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Ticket:
+    def __init__(self, model: str, thread_id: str) -> None:
+        self.model = model
+        self.thread_id = thread_id
+        self.admitted_at: Optional[float] = None
+        self.released = False
+
+
+# Admission control in front of the graph
+# A request runs when fewer than `max_in_flight` requests run in total and fewer than
+# the limit of its model run with that model, otherwise it waits in a queue of at most
+# `max_queue` requests for at most `queue_timeout` seconds. A full queue or a wait past
+# the timeout is rejected with 503 right away, so a burst doesn't slow every request down
+# Waiting requests are admitted round-robin between threads, and a thread can't have more
+# than `per_thread_limit` requests running or waiting (429), so one client can't take
+# the whole server
+# Limits are per server process
+class AdmissionController:
+    def __init__(
+        self,
+        max_in_flight: int = settings.ADMISSION_MAX_IN_FLIGHT,
+        model_limits: Dict[str, int] = settings.ADMISSION_MODEL_LIMITS,
+        default_model_limit: int = settings.ADMISSION_DEFAULT_MODEL_LIMIT,
+        max_queue: int = settings.ADMISSION_MAX_QUEUE,
+        queue_timeout: float = settings.ADMISSION_QUEUE_TIMEOUT,
+        per_thread_limit: int = settings.ADMISSION_PER_THREAD_LIMIT,
+    ) -> None:
+        self.max_in_flight = max_in_flight
+        self.model_limits = model_limits
+        self.default_model_limit = default_model_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.per_thread_limit = per_thread_limit
+
+        self._in_flight = 0
+        self._model_in_flight: Dict[str, int] = defaultdict(int)
+        self._model_queued: Dict[str, int] = defaultdict(int)
+        # thread_id -> requests running or waiting
+        self._thread_pending: Dict[str, int] = defaultdict(int)
+        # thread_id -> waiting requests, the order of the threads is the round-robin order
+        self._waiters: OrderedDict[str, Deque[Tuple[Ticket, asyncio.Future]]] = (
+            OrderedDict()
+        )
+        self._queued = 0
+
+        # Moving average of the request durations, used to estimate Retry-After
+        self._avg_seconds = 1.0
+        self._metrics = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_queue_full": 0,
+            "rejected_queue_timeout": 0,
+            "rejected_thread_limit": 0,
+        }
+
+    def model_limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.default_model_limit)
+
+    def _has_capacity(self, model: str) -> bool:
+        model_in_flight = self._model_in_flight[model]
+        return (
+            self._in_flight < self.max_in_flight
+            and model_in_flight < self.model_limit(model)
+        )
+
+    def _retry_after(self) -> int:
+        return max(
+            1, math.ceil(self._avg_seconds * (self._queued + 1) / self.max_in_flight)
+        )
+
+    def _admit(self, ticket: Ticket) -> None:
+        self._in_flight += 1
+        self._model_in_flight[ticket.model] += 1
+        ticket.admitted_at = time.monotonic()
+        self._metrics["admitted"] += 1
+
+    def _forget_thread(self, thread_id: str) -> None:
+        self._thread_pending[thread_id] -= 1
+        if self._thread_pending[thread_id] <= 0:
+            del self._thread_pending[thread_id]
+
+    def _reject(
+        self, ticket: Ticket, status_code: int, metric: str, reason: str
+    ) -> AdmissionRejected:
+        self._forget_thread(ticket.thread_id)
+        self._metrics[metric] += 1
+        return AdmissionRejected(status_code, self._retry_after(), reason)
+
+    def _remove_waiter(self, ticket: Ticket, future: asyncio.Future) -> None:
+        waiters = self._waiters.get(ticket.thread_id)
+        if waiters is None or (ticket, future) not in waiters:
+            return
+
+        waiters.remove((ticket, future))
+        if not waiters:
+            del self._waiters[ticket.thread_id]
+        self._queued -= 1
+        self._model_queued[ticket.model] -= 1
+
+    # Admits waiting requests while there is capacity, one per thread in turn
+    # A thread whose next request is for a saturated model is skipped this time
+    def _dispatch(self) -> None:
+        for thread_id in list(self._waiters):
+            if self._in_flight >= self.max_in_flight:
+                return
+
+            waiters = self._waiters.pop(thread_id)
+            ticket, future = waiters[0]
+            if self._model_in_flight[ticket.model] < self.model_limit(ticket.model):
+                waiters.popleft()
+                self._queued -= 1
+                self._model_queued[ticket.model] -= 1
+                self._admit(ticket)
+                future.set_result(None)
+
+            # Back at the end of the round-robin order
+            if waiters:
+                self._waiters[thread_id] = waiters
+
+    async def acquire(self, model: str, thread_id: str) -> Ticket:
+        ticket = Ticket(model, thread_id)
+        self._thread_pending[thread_id] += 1
+
+        if self._thread_pending[thread_id] > self.per_thread_limit:
+            raise self._reject(
+                ticket,
+                429,
+                "rejected_thread_limit",
+                "Too many requests in progress for this thread",
+            )
+
+        # Requests don't overtake the ones already waiting for the same model
+        if self._has_capacity(model) and not self._model_queued[model]:
+            self._admit(ticket)
+            return ticket
+
+        if self._queued >= self.max_queue:
+            raise self._reject(
+                ticket, 503, "rejected_queue_full", "The server is saturated"
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(thread_id, deque()).append((ticket, future))
+        self._queued += 1
+        self._model_queued[model] += 1
+        self._metrics["queued"] += 1
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # Admitted at the same time as the timeout
+            if future.done():
+                return ticket
+            self._remove_waiter(ticket, future)
+            raise self._reject(
+                ticket,
+                503,
+                "rejected_queue_timeout",
+                "The request waited too long to be admitted",
+            )
+        except asyncio.CancelledError:
+            if future.done():
+                self.release(ticket)
+            else:
+                self._remove_waiter(ticket, future)
+                self._forget_thread(thread_id)
+            raise
+
+        return ticket
+
+    # Frees the slot of an admitted request, safe to call more than once
+    def release(self, ticket: Ticket) -> None:
+        if ticket.released or ticket.admitted_at is None:
+            return
+        ticket.released = True
+
+        self._in_flight -= 1
+        self._model_in_flight[ticket.model] -= 1
+        self._forget_thread(ticket.thread_id)
+
+        seconds = time.monotonic() - ticket.admitted_at
+        self._avg_seconds = 0.9 * self._avg_seconds + 0.1 * seconds
+
+        self._dispatch()
+
+    def stats(self) -> Dict:
+        return {
+            **self._metrics,
+            "in_flight": self._in_flight,
+            "waiting": self._queued,
+            "models_in_flight": {m: n for m, n in self._model_in_flight.items() if n},
+            "avg_seconds": round(self._avg_seconds, 3),
+        }
+
+
+admission = AdmissionController()
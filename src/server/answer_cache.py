@@ -0,0 +1,96 @@
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import settings
+from retriever.retriever import PGRetriever, pg_retriever
+
+
+class CachedAnswer:
+    def __init__(self, question: str, vector: np.ndarray, messages: List[Dict]) -> None:
+        self.question = question
+        self.vector = vector
+        # ChatMessage dumps (tool calls, tool results and the answer) as streamed the first time
+        self.messages = messages
+        self.created_at = time.monotonic()
+
+
+# Semantic cache of complete answers in front of the graph
+# A question whose embedding is at least `threshold` similar (cosine) to an answered one
+# of the same model gets the stored messages replayed instead of running the graph
+# Answers are scoped by a data version that is bumped whenever a table or the schema
+# changes, stale answers are dropped at that point
+class AnswerCache:
+    def __init__(
+        self,
+        retriever: PGRetriever = pg_retriever,
+        threshold: float = settings.ANSWER_CACHE_THRESHOLD,
+        max_entries: int = settings.ANSWER_CACHE_MAX_ENTRIES,
+        ttl: float = settings.ANSWER_CACHE_TTL,
+    ) -> None:
+        self.retriever = retriever
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.data_version = 0
+
+        # model -> answers, oldest first
+        self._answers: Dict[str, List[CachedAnswer]] = {}
+        self._metrics = {"hits": 0, "misses": 0, "stored": 0, "invalidations": 0}
+
+    # Uses the retriever's embedding memo, so a miss doesn't embed the question twice
+    async def embed(self, question: str) -> np.ndarray:
+        return await self.retriever.aembed_query_array(question)
+
+    def lookup(self, vector: np.ndarray, model: str) -> Optional[CachedAnswer]:
+        answers = self._answers.get(model, [])
+
+        expired_before = time.monotonic() - self.ttl
+        answers[:] = [a for a in answers if a.created_at >= expired_before]
+
+        if answers:
+            similarities = np.stack([a.vector for a in answers]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                self._metrics["hits"] += 1
+                return answers[best]
+
+        self._metrics["misses"] += 1
+        return None
+
+    # `data_version` is the version the answer was computed at, answers computed
+    # while the data changed are not stored
+    def store(
+        self,
+        vector: np.ndarray,
+        model: str,
+        question: str,
+        messages: List[Dict],
+        data_version: int,
+    ) -> None:
+        if data_version != self.data_version:
+            return
+
+        answers = self._answers.setdefault(model, [])
+        answers.append(CachedAnswer(question, vector, messages))
+        del answers[: -self.max_entries]
+        self._metrics["stored"] += 1
+
+    # Listener callback for the table and schema channels
+    def on_notify(self, payload: str) -> None:
+        self.data_version += 1
+        self._answers.clear()
+        self._metrics["invalidations"] += 1
+
+    def stats(self) -> Dict:
+        lookups = self._metrics["hits"] + self._metrics["misses"]
+        return {
+            **self._metrics,
+            "hit_rate": self._metrics["hits"] / lookups if lookups else 0.0,
+            "entries": sum(len(answers) for answers in self._answers.values()),
+            "data_version": self.data_version,
+        }
+
+
+answer_cache = AnswerCache()
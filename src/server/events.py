@@ -0,0 +1,68 @@
+from typing import Any, Callable, Dict, List, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, ToolCall, ToolMessage
+from langgraph.types import Command
+
+from agents.utils import convert_rows_to_markdown
+
+# Custom events that start a tool step -> name of the tool call shown to the client and
+# the event data keys sent as its arguments (data key -> argument)
+TOOL_CALL_EVENTS: Dict[str, Tuple[str, Dict[str, str]]] = {
+    "on_get_tables_start": ("identify tables", {"query": "user_query"}),
+    "on_get_core_subject_start": ("Get core subject", {"input": "input"}),
+    "on_retriever_start": (
+        "Postgres Retriever",
+        {"sql_query": "sql_query", "user_query": "user_query"},
+    ),
+}
+
+# Custom events that end a tool step -> content of the tool result
+TOOL_RESULT_EVENTS: Dict[str, Callable[[Dict], str]] = {
+    "on_get_tables_end": lambda data: data["result"],
+    "on_get_core_subject_end": lambda data: data["result"],
+    "on_retriever_end": lambda data: convert_rows_to_markdown(data["result"]) or "N/A",
+    "on_retriever_error": lambda data: data["error"],
+}
+
+
+# Messages streamed to the client for a custom event of the agents, none for the events
+# that are not shown (e.g. on_prompt_size)
+def translate_custom_event(event: Dict[str, Any]) -> List[BaseMessage]:
+    event_type, data = event["type"], event["data"]
+
+    if event_type in TOOL_CALL_EVENTS:
+        name, arguments = TOOL_CALL_EVENTS[event_type]
+        tool_call = ToolCall(
+            name=name,
+            args={arg: data[key] for key, arg in arguments.items()},
+            id=data["tool_call_id"],
+        )
+        return [AIMessage(content="", tool_calls=[tool_call])]
+
+    if event_type in TOOL_RESULT_EVENTS:
+        content = TOOL_RESULT_EVENTS[event_type](data)
+        return [ToolMessage(content=content, tool_call_id=data["tool_call_id"])]
+
+    return []
+
+
+# Messages of a node update: a state update, or the Commands returned by the tools
+def update_messages(update: Any) -> List[BaseMessage]:
+    messages = []
+    for item in update if isinstance(update, list) else [update]:
+        if isinstance(item, Command):
+            item = item.update
+        if isinstance(item, dict):
+            messages.extend(item.get("messages", []))
+    return messages
+
+
+# Answers written by the nodes of one "updates" stream chunk (node -> update)
+# Tool steps are streamed from the custom events, so only answers are taken
+def translate_updates(chunk: Dict[str, Any]) -> List[BaseMessage]:
+    return [
+        message
+        for update in chunk.values()
+        for message in update_messages(update)
+        if isinstance(message, AIMessage) and message.content
+    ]
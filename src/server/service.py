@@ -1,44 +1,57 @@
+import asyncio
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import Any, AsyncGenerator
 from uuid import uuid4
 
-from fastapi import APIRouter, FastAPI
+from fastapi import APIRouter, FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
-from langchain_core.messages import AIMessage, HumanMessage, ToolCall, ToolMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
 from langchain_core.runnables import RunnableConfig
 from langgraph.graph.state import CompiledStateGraph
+from starlette.background import BackgroundTask
 
 from agents.pg_agent import pg_rag
+from agents.plan_cache import plan_cache
 
 # from agents.pg_predefined import pg_rag
-from agents.utils import convert_rows_to_markdown
+from agents.utils import ANSWER_TAG
+from config import settings
+from database.catalog import schema_catalog
+from database.listener import pg_listener
+from database.pool import pg_pool
 from models.schemas import StreamInput, UserInput
-from server.utils import langchain_to_chat_message
+from retriever.retriever import pg_retriever
+from server.admission import AdmissionRejected, Ticket, admission
+from server.answer_cache import answer_cache
+from server.events import translate_custom_event, translate_updates
+from server.thread_store import run_eviction, thread_store
+from server.utils import chunk_text, langchain_to_chat_message
 
 router = APIRouter()
 
-# In-memory message store (thread_id -> List[BaseMessage])
-thread_messages: dict[str, list] = {}
 
-
-def parse_input(user_input: UserInput) -> tuple[dict[str, Any], str]:
+# The graph gets the recent history of the thread (bounded by the thread store window)
+# followed by the new message
+async def parse_input(user_input: UserInput) -> tuple[dict[str, Any], str, str, bool]:
     run_id = str(uuid4())
     thread_id = user_input.thread_id or run_id
 
-    if thread_id not in thread_messages:
-        thread_messages[thread_id] = []
+    history = await thread_store.load(thread_id)
 
     human_msg = HumanMessage(content=user_input.message)
-    thread_messages[thread_id].append(human_msg)
+    await thread_store.append(thread_id, [human_msg])
 
     kwargs = {
-        "input": {"messages": thread_messages[thread_id]},
+        "input": {"messages": history + [human_msg]},
         "config": RunnableConfig(
             configurable={"thread_id": thread_id, "model": user_input.model},
             run_id=run_id,
         ),
     }
-    return kwargs, run_id, thread_id
+    return kwargs, run_id, thread_id, not history
 
 
 @router.get("/")
@@ -46,140 +59,209 @@ async def root():
     return {"message": "Hello World"}
 
 
+# Liveness of a worker, the pid tells the workers behind the port apart
+@router.get("/health")
+async def health():
+    return {"status": "ok", "pid": os.getpid()}
+
+
+@router.get("/metrics")
+async def metrics():
+    return {
+        "pid": os.getpid(),
+        "pg_pool": pg_pool.stats(),
+        "schema_catalog": schema_catalog.stats(),
+        "embedding_cache": pg_retriever.embedding_cache_stats(),
+        "result_cache": pg_retriever.result_cache_stats(),
+        "answer_cache": answer_cache.stats(),
+        "plan_cache": plan_cache.stats(),
+        "thread_store": thread_store.stats(),
+        "admission": admission.stats(),
+    }
+
+
 # Endpoint streams a response to the client
+# Requests over the admission limits are rejected before anything is streamed
 @router.post("/stream")
 async def agent_stream(user_input: StreamInput) -> StreamingResponse:
+    if not settings.ADMISSION_ENABLED:
+        return StreamingResponse(
+            message_generator(user_input), media_type="text/event-stream"
+        )
+
+    # Requests without a thread are a thread of their own
+    user_input.thread_id = user_input.thread_id or str(uuid4())
+    try:
+        ticket = await admission.acquire(user_input.model, user_input.thread_id)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=e.reason,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
     return StreamingResponse(
-        message_generator(user_input), media_type="text/event-stream"
+        admitted_stream(message_generator(user_input), ticket),
+        media_type="text/event-stream",
+        # The stream may never start if the client is gone, the slot is freed anyway
+        background=BackgroundTask(admission.release, ticket),
     )
 
 
+# Frees the admission slot as soon as the stream ends or the client disconnects
+async def admitted_stream(
+    generator: AsyncGenerator[str, None], ticket: Ticket
+) -> AsyncGenerator[str, None]:
+    try:
+        async for chunk in generator:
+            yield chunk
+    finally:
+        admission.release(ticket)
+
+
 async def message_generator(
     user_input: StreamInput,
 ) -> AsyncGenerator[str, None]:
     agent: CompiledStateGraph = pg_rag
     # The config that will help keep track of the agents phases and events through the graph
-    kwargs, run_id, thread_id = parse_input(user_input)
-
-    async for event in agent.astream_events(**kwargs, version="v2"):
-        if not event:
-            continue
+    kwargs, run_id, thread_id, first_turn = await parse_input(user_input)
 
-        # Every tool event has a start and ending, the start of the event will be a AIMessage
-        # with toolcalls and the end of the event will be a tool message
+    # FAQ-style questions are answered from the semantic cache without running the graph
+    # Follow-up questions depend on the conversation, so by default only first turns use it
+    use_answer_cache = settings.ANSWER_CACHE_ENABLED and (
+        not settings.ANSWER_CACHE_FIRST_TURN_ONLY or first_turn
+    )
+    if use_answer_cache:
+        data_version = answer_cache.data_version
+        try:
+            vector = await answer_cache.embed(user_input.message)
+        except Exception as e:
+            print(f"Failed to embed the question for the answer cache: {e}")
+            use_answer_cache = False
+
+    if use_answer_cache:
+        cached = answer_cache.lookup(vector, user_input.model)
+        if cached is not None:
+            for message in cached.messages:
+                if message["role"] == "ai" and message["content"]:
+                    await thread_store.append(
+                        thread_id, [AIMessage(content=message["content"])]
+                    )
+                yield f"data: {json.dumps({'status': True, 'data': {**message, 'run_id': run_id}})}\n\n"
+
+            yield "data: DONE!\n\n"
+            return
+
+    streamed_messages = []
+    tool_call_tokens = 0
+
+    # Only the node updates, the custom events of the agents and, when asked, the chat
+    # model tokens are streamed by the graph
+    stream_mode = ["updates", "custom"]
+    if user_input.stream_tokens:
+        stream_mode.append("messages")
+
+    async for mode, chunk in agent.astream(**kwargs, stream_mode=stream_mode):
         new_messages = []
-        if (
-            event["event"] == "on_chain_end"
-            and any(t.startswith("graph:step:") for t in event.get("tags", []))
-            and "messages" in event["data"]["output"]
-        ):
-            msgs = event["data"]["output"]["messages"]
-            for msg in msgs:
-                if msg.content:
-                    new_messages.append(msg)
-                    thread_messages[thread_id].append(AIMessage(content=msg.content))
-
-        # Custom events like on_get_core_subject_start, on_get_tables_start used in langgraph
-        if event["event"] == "on_custom_event" and "custom_data_dispatch" in event.get(
-            "tags", []
-        ):
-            if event["name"] == "on_get_core_subject_start":
-                msg = AIMessage(
-                    content="",
-                    tool_calls=[
-                        ToolCall(
-                            name="Get core subject",
-                            args={"input": event["data"]["input"]},
-                            id=event["data"]["tool_call_id"],
-                        )
-                    ],
-                )
-                new_messages = [msg]
 
-            if event["name"] == "on_get_core_subject_end":
-                msg = ToolMessage(
-                    content=event["data"]["result"],
-                    tool_call_id=event["data"]["tool_call_id"],
-                )
-                new_messages = [msg]
-
-            if event["name"] == "on_retriever_error":
-                msg = ToolMessage(
-                    content=event["data"]["error"],
-                    tool_call_id=event["data"]["tool_call_id"],
-                )
-                new_messages = [msg]
-
-            if event["name"] == "on_get_tables_start":
-                args = {}
-                for k, v in event["data"].items():
-                    args[k] = v
-
-                msg = AIMessage(
-                    content="",
-                    tool_calls=[
-                        ToolCall(
-                            name="identify tables",
-                            args={"user_query": args["query"]},
-                            id=args["tool_call_id"],
-                        )
-                    ],
-                )
-                new_messages = [msg]
+        # Tokens of the answer are sent as they are generated, the complete answer still
+        # follows with the update of its node
+        if mode == "messages":
+            message, metadata = chunk
+            if isinstance(message, AIMessageChunk) and ANSWER_TAG in metadata.get(
+                "tags", []
+            ):
+                content = chunk_text(message.content)
+                if content:
+                    yield f"data: {json.dumps({'status': True, 'type': 'token', 'data': content})}\n\n"
+            continue
 
-            if event["name"] == "on_get_tables_end":
-                msg = ToolMessage(
-                    content=event["data"]["result"],
-                    tool_call_id=event["data"]["tool_call_id"],
-                )
-                new_messages = [msg]
-
-            if event["name"] == "on_retriever_start":
-                args = {}
-                for k, v in event["data"].items():
-                    args[k] = v
-
-                msg = AIMessage(
-                    content="",
-                    tool_calls=[
-                        ToolCall(
-                            name="Postgres Retriever",
-                            args={
-                                "sql_query": args["sql_query"],
-                                "user_query": args["user_query"],
-                            },
-                            id=args["tool_call_id"],
-                        )
-                    ],
+        if mode == "updates":
+            new_messages = translate_updates(chunk)
+            if new_messages:
+                await thread_store.append(
+                    thread_id, [AIMessage(content=m.content) for m in new_messages]
                 )
 
-                new_messages = [msg]
+        if mode == "custom":
+            # Token sizes of the LLM calls are logged, not sent to the client
+            if chunk["type"] == "on_prompt_size":
+                print(f"Prompt size of run {run_id}: {json.dumps(chunk['data'])}")
+                tool_call_tokens += chunk["data"].get("tool_call_tokens", 0)
 
-            if event["name"] == "on_retriever_end":
-                retrived_docs = event["data"]["result"]
-                if len(retrived_docs) == 0:
-                    context = "N/A"
-                else:
-                    context = convert_rows_to_markdown(retrived_docs)
-
-                msg = ToolMessage(
-                    content=context,
-                    tool_call_id=event["data"]["tool_call_id"],
-                )
-                new_messages = [msg]
+            new_messages = translate_custom_event(chunk)
 
         # All the messages will be converted to the Chatmessage with respective roles
         # and be streamed to client as soon as they are generated
         for message in new_messages:
             try:
                 chat_message = langchain_to_chat_message(message, run_id)
+                streamed_messages.append(chat_message.model_dump(exclude={"run_id"}))
                 yield f"data: {json.dumps({'status': True, 'data': chat_message.model_dump()})}\n\n"
             except Exception as e:
                 yield f"data: {json.dumps({'status': False, 'data': str(e)})}\n\n"
                 continue
 
+    print(f"Tool-call tokens of run {run_id}: {tool_call_tokens}")
+
+    answered = any(m["role"] == "ai" and m["content"] for m in streamed_messages)
+    if use_answer_cache and answered:
+        answer_cache.store(
+            vector,
+            user_input.model,
+            user_input.message,
+            streamed_messages,
+            data_version,
+        )
+
     yield "data: DONE!\n\n"
 
 
-app = FastAPI()
+# Warms the connection pool and the schema catalog before the first request
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Bounded, so blocking leftovers queue up instead of piling up threads
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=settings.BLOCKING_THREAD_POOL_SIZE,
+            thread_name_prefix="blocking",
+        )
+    )
+
+    await pg_pool.open()
+
+    pg_listener.subscribe(settings.SCHEMA_CATALOG_CHANNEL, schema_catalog.on_notify)
+    pg_listener.subscribe(settings.SCHEMA_CATALOG_CHANNEL, plan_cache.on_notify)
+    if pg_retriever.result_cache is not None:
+        # Renamed or added columns change what a cached statement would return
+        pg_listener.subscribe(
+            settings.SCHEMA_CATALOG_CHANNEL,
+            lambda payload: pg_retriever.result_cache.clear(),
+        )
+        pg_listener.subscribe(
+            settings.RESULT_CACHE_CHANNEL, pg_retriever.result_cache.on_notify
+        )
+    if settings.ANSWER_CACHE_ENABLED:
+        pg_listener.subscribe(settings.SCHEMA_CATALOG_CHANNEL, answer_cache.on_notify)
+        pg_listener.subscribe(settings.RESULT_CACHE_CHANNEL, answer_cache.on_notify)
+    await pg_listener.start()
+
+    # Warmed before the worker accepts requests, so its first requests don't pay for it
+    try:
+        await schema_catalog.load()
+        if settings.TABLE_ROUTING_ENABLED:
+            await schema_catalog.get_table_vectors()
+    except Exception as e:
+        print(f"Failed to warm the schema catalog: {e}")
+
+    eviction = asyncio.create_task(run_eviction(thread_store))
+
+    yield
+
+    eviction.cancel()
+    await pg_listener.stop()
+    await pg_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(router)
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List
+
+from langchain_core.messages import (
+    BaseMessage,
+    HumanMessage,
+    message_to_dict,
+    messages_from_dict,
+)
+
+from config import settings
+
+
+# Last `max_messages` messages of a thread, starting at a human message so the window
+# never opens with an answer to a question that was cut off
+def trim_history(messages: List[BaseMessage], max_messages: int) -> List[BaseMessage]:
+    window = messages[-max_messages:] if max_messages > 0 else []
+    for i, message in enumerate(window):
+        if isinstance(message, HumanMessage):
+            return window[i:]
+    return []
+
+
+# Long contents (tool results, pasted data) are cut before they are stored
+def cap_content(message: BaseMessage, max_chars: int) -> BaseMessage:
+    if isinstance(message.content, str) and len(message.content) > max_chars:
+        return message.model_copy(
+            update={"content": message.content[:max_chars] + "..."}
+        )
+    return message
+
+
+# Conversation history of the server, one list of messages per thread
+# Threads keep their last `max_messages` messages (what is sent to the LLM on every turn),
+# message contents are capped to `max_message_chars` and threads idle for more than
+# `idle_ttl` seconds are evicted by evict_idle()
+class ThreadStore(ABC):
+    def __init__(
+        self,
+        max_messages: int = settings.THREAD_HISTORY_MAX_MESSAGES,
+        max_message_chars: int = settings.THREAD_STORE_MAX_MESSAGE_CHARS,
+        idle_ttl: float = settings.THREAD_STORE_IDLE_TTL,
+    ) -> None:
+        self.max_messages = max_messages
+        self.max_message_chars = max_message_chars
+        self.idle_ttl = idle_ttl
+
+        self._metrics = {"appended": 0, "truncated": 0, "evicted": 0}
+
+    @abstractmethod
+    async def load(self, thread_id: str) -> List[BaseMessage]:
+        pass
+
+    @abstractmethod
+    async def append(self, thread_id: str, messages: List[BaseMessage]) -> None:
+        pass
+
+    # Drops the threads idle for more than idle_ttl, returns how many were dropped
+    @abstractmethod
+    async def evict_idle(self) -> int:
+        pass
+
+    def _cap(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        capped = [cap_content(m, self.max_message_chars) for m in messages]
+        self._metrics["appended"] += len(messages)
+        self._metrics["truncated"] += sum(a is not b for a, b in zip(capped, messages))
+        return capped
+
+    def stats(self) -> Dict:
+        return dict(self._metrics)
+
+
+# In-process store, lost on restart, for development and tests
+# Also bounded in the number of threads, the least recently used ones are dropped first
+class MemoryThreadStore(ThreadStore):
+    def __init__(
+        self, max_threads: int = settings.THREAD_STORE_MAX_THREADS, **kwargs
+    ) -> None:
+        super().__init__(**kwargs)
+        self.max_threads = max_threads
+
+        # thread_id -> (last activity, messages)
+        self._threads: OrderedDict[str, tuple] = OrderedDict()
+
+    async def load(self, thread_id: str) -> List[BaseMessage]:
+        _, messages = self._threads.get(thread_id, (0.0, []))
+        return trim_history(messages, self.max_messages)
+
+    async def append(self, thread_id: str, messages: List[BaseMessage]) -> None:
+        _, history = self._threads.pop(thread_id, (0.0, []))
+        history = (history + self._cap(messages))[-self.max_messages :]
+        self._threads[thread_id] = (time.time(), history)
+
+        while len(self._threads) > self.max_threads:
+            self._threads.popitem(last=False)
+            self._metrics["evicted"] += 1
+
+    async def evict_idle(self) -> int:
+        expired_before = time.time() - self.idle_ttl
+        expired = [t for t, (at, _) in self._threads.items() if at < expired_before]
+        for thread_id in expired:
+            del self._threads[thread_id]
+
+        self._metrics["evicted"] += len(expired)
+        return len(expired)
+
+    def stats(self) -> Dict:
+        return {**super().stats(), "threads": len(self._threads)}
+
+
+# Local SQLite file, survives restarts and is shared by the workers of one host (WAL)
+# Every call opens its own connection in the default executor, SQLite is blocking
+class SQLiteThreadStore(ThreadStore):
+    def __init__(self, path: str = settings.THREAD_STORE_PATH, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.path = path
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS threads (
+                    thread_id TEXT PRIMARY KEY,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS threads_updated_at_idx
+                    ON threads (updated_at);
+                CREATE TABLE IF NOT EXISTS thread_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    thread_id TEXT NOT NULL,
+                    message TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS thread_messages_thread_id_idx
+                    ON thread_messages (thread_id, id);
+                """
+            )
+            self._initialized = True
+        return conn
+
+    def _load(self, thread_id: str) -> List[BaseMessage]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                """
+                SELECT message FROM (
+                    SELECT id, message FROM thread_messages
+                    WHERE thread_id = ? ORDER BY id DESC LIMIT ?
+                ) ORDER BY id
+                """,
+                (thread_id, self.max_messages),
+            ).fetchall()
+        finally:
+            conn.close()
+
+        messages = messages_from_dict([json.loads(row[0]) for row in rows])
+        return trim_history(messages, self.max_messages)
+
+    # Older messages than the window are deleted, so a thread never stores more than
+    # what is sent to the LLM
+    def _append(self, thread_id: str, messages: List[BaseMessage]) -> None:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO thread_messages (thread_id, message) VALUES (?, ?)",
+                    [(thread_id, json.dumps(message_to_dict(m))) for m in messages],
+                )
+                conn.execute(
+                    """
+                    DELETE FROM thread_messages
+                    WHERE thread_id = ? AND id NOT IN (
+                        SELECT id FROM thread_messages
+                        WHERE thread_id = ? ORDER BY id DESC LIMIT ?
+                    )
+                    """,
+                    (thread_id, thread_id, self.max_messages),
+                )
+                conn.execute(
+                    """
+                    INSERT INTO threads (thread_id, updated_at) VALUES (?, ?)
+                    ON CONFLICT (thread_id) DO UPDATE SET updated_at = excluded.updated_at
+                    """,
+                    (thread_id, time.time()),
+                )
+        finally:
+            conn.close()
+
+    def _evict_idle(self) -> int:
+        expired_before = time.time() - self.idle_ttl
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    """
+                    DELETE FROM thread_messages WHERE thread_id IN (
+                        SELECT thread_id FROM threads WHERE updated_at < ?
+                    )
+                    """,
+                    (expired_before,),
+                )
+                return conn.execute(
+                    "DELETE FROM threads WHERE updated_at < ?", (expired_before,)
+                ).rowcount
+        finally:
+            conn.close()
+
+    async def load(self, thread_id: str) -> List[BaseMessage]:
+        return await asyncio.to_thread(self._load, thread_id)
+
+    async def append(self, thread_id: str, messages: List[BaseMessage]) -> None:
+        await asyncio.to_thread(self._append, thread_id, self._cap(messages))
+
+    async def evict_idle(self) -> int:
+        evicted = await asyncio.to_thread(self._evict_idle)
+        self._metrics["evicted"] += evicted
+        return evicted
+
+
+# Evicts idle threads every THREAD_STORE_EVICT_INTERVAL seconds until cancelled
+async def run_eviction(store: ThreadStore) -> None:
+    while True:
+        await asyncio.sleep(settings.THREAD_STORE_EVICT_INTERVAL)
+        try:
+            evicted = await store.evict_idle()
+            if evicted:
+                print(f"Evicted {evicted} idle threads")
+        except Exception as e:
+            print(f"Failed to evict idle threads: {e}")
+
+
+# A memory store isn't shared, the next turn of a thread may reach another worker
+if settings.SERVER_WORKERS > 1 and settings.THREAD_STORE == "memory":
+    raise RuntimeError(
+        f"THREAD_STORE=memory can't be shared between {settings.SERVER_WORKERS} workers"
+    )
+
+thread_store: ThreadStore = (
+    SQLiteThreadStore() if settings.THREAD_STORE == "sqlite" else MemoryThreadStore()
+)
@@ -1,8 +1,19 @@
+from typing import Any
+
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
 
 from models.schemas import ChatMessage
 
 
+# Text of a streamed chunk, some providers send a list of content blocks instead of a string
+def chunk_text(content: str | list[Any]) -> str:
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block if isinstance(block, str) else block.get("text", "") for block in content
+    )
+
+
 def langchain_to_chat_message(message: BaseMessage, run_id: str) -> ChatMessage:
     """Create a ChatMessage from a LangChain message."""
     match message:
@@ -88,9 +88,26 @@ async def draw_messages(
     last_message_type = None
     st.session_state.last_message = None
 
+    # Statements run concurrently, so tool results can arrive after other tool calls
+    call_results = {}
+
+    # Tokens of the answer are rendered as they arrive, then replaced by the full answer
+    streamed_text = ""
+    st.session_state.streaming_placeholder = None
+
     while msg := await anext(messages_generator, None):
         if isinstance(msg, str):
-            st.write(msg)
+            if last_message_type != "ai":
+                last_message_type = "ai"
+                st.session_state.last_message = st.chat_message("ai")
+
+            if st.session_state.streaming_placeholder is None:
+                with st.session_state.last_message:
+                    st.session_state.streaming_placeholder = st.empty()
+                streamed_text = ""
+
+            streamed_text += msg
+            st.session_state.streaming_placeholder.write(streamed_text)
             continue
 
         if not isinstance(msg, ChatMessage):
@@ -112,11 +129,13 @@ async def draw_messages(
                     st.session_state.last_message = st.chat_message("ai")
 
                 with st.session_state.last_message:
-                    if msg.content:
+                    if msg.content and st.session_state.streaming_placeholder:
+                        st.session_state.streaming_placeholder.write(msg.content)
+                        st.session_state.streaming_placeholder = None
+                    elif msg.content:
                         st.write(msg.content)
 
                     if msg.tool_calls:
-                        call_results = {}
                         for tool_call in msg.tool_calls:
                             status = st.status(
                                 f"""Tool Call: {tool_call["name"]}""",
@@ -126,21 +145,19 @@ async def draw_messages(
                             status.write("Input:")
                             status.write(tool_call["args"])
 
-                        for _ in range(len(call_results)):
-                            tool_result: ChatMessage = await anext(messages_generator)
-                            if tool_result.role != "tool":
-                                st.error(
-                                    f"Unexpected ChatMessage type: {tool_result.role}"
-                                )
-                                st.write(tool_result)
-                                st.stop()
-
-                            if is_new:
-                                st.session_state.messages.append(tool_result)
-                            status = call_results[tool_result.tool_call_id]
-                            status.write("Output:")
-                            status.write(tool_result.content)
-                            status.update(state="complete")
+            case "tool":
+                if is_new:
+                    st.session_state.messages.append(msg)
+
+                status = call_results.pop(msg.tool_call_id, None)
+                if status is None:
+                    st.error(f"Unexpected tool result: {msg.tool_call_id}")
+                    st.write(msg)
+                    st.stop()
+
+                status.write("Output:")
+                status.write(msg.content)
+                status.update(state="complete")
 
 
 if __name__ == "__main__":